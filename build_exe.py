@@ -6,6 +6,8 @@ import os
 import subprocess
 import sys
 import shutil
+import tempfile
+import time
 
 def build_exe():
     """Build executable with PyInstaller"""
@@ -28,6 +30,13 @@ def build_exe():
         "--hidden-import=PIL",          # Ensure PIL is included
         "--hidden-import=tkinter",      # Ensure tkinter is included
         "--hidden-import=pyautogui",    # Ensure pyautogui is included
+        # wplace_core imports these lazily (on first use), so the static
+        # import scan can't see them
+        "--hidden-import=numpy",
+        "--hidden-import=PIL.Image",
+        "--hidden-import=PIL.ImageChops",
+        "--hidden-import=PIL.ImageMath",
+        "--hidden-import=PIL.ImageTk",
         "wplace_drawer2.py"
     ]
     
@@ -53,6 +62,36 @@ def build_exe():
     
     return True
 
+def measure_startup(exe_path="dist/WplaceDrawer2.exe", runs=3):
+    """Launch the built app with --startup-timing and report how long it takes.
+
+    Wall time covers the onefile unpacking too; the app itself appends its
+    import / window-ready times to a file (a windowed build has no console).
+    """
+    if not os.path.exists(exe_path):
+        return
+    print("⏱️  Measuring startup time...")
+    fd, log_path = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    walls = []
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([os.path.abspath(exe_path), f"--startup-timing={log_path}"], timeout=120)
+            walls.append(time.perf_counter() - start)
+        with open(log_path, encoding="utf-8") as f:
+            reports = [line.strip() for line in f if line.strip()]
+    except (OSError, subprocess.SubprocessError) as e:
+        print(f"⚠️  Startup measurement failed: {e}")
+        return
+    finally:
+        os.remove(log_path)
+    walls.sort()
+    print(f"   process wall time: median {walls[len(walls) // 2] * 1000:.0f} ms "
+          f"(min {walls[0] * 1000:.0f}, max {walls[-1] * 1000:.0f})")
+    for line in reports:
+        print(f"   app: {line}")
+
 def create_release_folder():
     """Create release folder with executable and docs"""
     print("📁 Creating release folder...")
@@ -85,6 +124,7 @@ if __name__ == "__main__":
     print("="*40)
     
     if build_exe():
+        measure_startup()
         create_release_folder()
         print("\n🎉 Build complete! Ready for distribution.")
     else:
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wplace_core as core  # noqa: E402
+
+
+@pytest.fixture(params=["numpy", "pure"])
+def backend(request, monkeypatch):
+    """Run a test with NumPy and again with the pure-Python fallbacks"""
+    if request.param == "numpy":
+        if core.np is None:
+            pytest.skip("NumPy not installed")
+    else:
+        monkeypatch.setattr(core, "np", None)
+    return request.param
+
+
+class FakeClock:
+    """clock()/sleep() pair for ChargeBudget: time only moves when slept"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+        return False
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
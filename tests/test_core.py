@@ -0,0 +1,200 @@
+"""Tests for the GUI-free core: charges, verification, playback, journal, calibration."""
+import random
+
+import pytest
+from PIL import Image
+
+import wplace_core as core
+from wplace_core import (
+    CellGrid, ChargeBudget, DrawCostModel, DrawJournal, ImageCapture, RecordingDriver,
+    diff_cells, hex_to_rgb, plan_color_sequence, plan_key, predict_sequence_duration, quantize_image,
+)
+
+
+def make_plan(width=12, height=9, colors=4, seed=0):
+    """Quantized random image over the first `colors` palette entries, ~10% transparent"""
+    rnd = random.Random(seed)
+    palette = core.get_palette()[:colors]
+    img = Image.new("RGBA", (width, height))
+    img.putdata([hex_to_rgb(rnd.choice(palette)) + (0 if rnd.random() < 0.1 else 255,)
+                 for _ in range(width * height)])
+    return quantize_image(img, 128)
+
+
+# --- ChargeBudget ---
+
+def test_budget_burst_then_waits_one_regen_per_charge(clock):
+    budget = ChargeBudget(capacity=5, regen=30, tokens=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        assert budget.acquire()
+    assert clock.now == 0  # the burst spends stored charges without waiting
+    assert budget.wait_time() == 30
+    assert budget.acquire()
+    assert clock.now == 30
+    assert max(clock.slept) <= 1.0  # wakes every second for the countdown
+    assert budget.acquire()
+    assert clock.now == 60
+
+
+def test_budget_refill_is_capped(clock):
+    budget = ChargeBudget(capacity=4, regen=10, tokens=0, clock=clock, sleep=clock.sleep)
+    clock.now = 1000
+    assert budget.available() == 4
+
+
+def test_budget_prediction_matches_simulated_run(clock):
+    budget = ChargeBudget(capacity=10, regen=7, tokens=4, clock=clock, sleep=clock.sleep)
+    clock.now = 3  # part of the next charge has regenerated already
+    click = 0.5
+    predicted = budget.time_to_paint(25, click)
+    start = clock.now
+    for _ in range(25):
+        assert budget.acquire()
+        clock.now += click
+    assert clock.now - start == pytest.approx(predicted)
+
+
+def test_budget_interrupted_wait(clock):
+    budget = ChargeBudget(capacity=2, regen=30, tokens=0, clock=clock, sleep=lambda seconds: True)
+    assert budget.acquire() is False
+    assert budget.tokens == 0
+
+
+# --- Screenshot verification ---
+
+def render_canvas(qimg, mask, grid, cell=8, bg=(255, 255, 255)):
+    """Screenshot of a canvas showing every masked cell in its color, centered on the grid"""
+    w, h = qimg.size
+    shot = Image.new("RGB", (grid.xs[-1] + cell, grid.ys[-1] + cell), bg)
+    for y in range(h):
+        for x in range(w):
+            if mask[x, y]:
+                sx, sy = grid(x, y)
+                shot.paste(hex_to_rgb(qimg.hex_at(x, y)), (sx - cell // 2, sy - cell // 2,
+                                                           sx + cell // 2, sy + cell // 2))
+    return shot
+
+
+def test_diff_cells_finds_griefed_cells_in_saved_screenshot(backend, tmp_path):
+    qimg, mask = make_plan()
+    w, h = qimg.size
+    grid = CellGrid(w, h, (10, 20), br=(10 + (w - 1) * 8, 20 + (h - 1) * 8))
+    shot = render_canvas(qimg, mask, grid)
+    griefed = [(x, y) for x, y in ((0, 0), (5, 3), (w - 1, h - 1), (7, 8)) if mask[x, y]]
+    for x, y in griefed:
+        r, g, b = hex_to_rgb(qimg.hex_at(x, y))
+        shot.putpixel(grid(x, y), (255 - r, 255 - g, 255 - b))
+    path = tmp_path / "canvas.png"
+    shot.save(path)
+
+    bad = diff_cells(qimg, mask, grid, ImageCapture(str(path)))
+    assert sorted(zip(bad.xs, bad.ys)) == sorted(griefed)
+
+
+def test_diff_cells_honours_capture_origin_and_tolerance(backend):
+    qimg, mask = make_plan(6, 5)
+    grid = CellGrid(6, 5, (500, 300), br=(540, 332))
+    shot = render_canvas(qimg, mask, grid)
+    # the saved image starts at screen (480, 280); shift every color slightly
+    shifted = Image.new("RGB", (shot.width + 20, shot.height + 20))
+    shifted.paste(shot.crop((480, 280, shot.width, shot.height)), (0, 0))
+    shifted = Image.eval(shifted, lambda v: min(255, v + 10))
+    capture = ImageCapture(shifted, origin=(480, 280))
+    assert len(diff_cells(qimg, mask, grid, capture, tol=12)) == 0
+    assert len(diff_cells(qimg, mask, grid, capture, tol=5)) > 0
+
+
+# --- Playback through RecordingDriver ---
+
+def play(driver, sequence, grid, swatch_of, model):
+    """Drive a ("COLOR", hx) / PixelSet sequence the way the app's draw worker does"""
+    for item in sequence:
+        if isinstance(item, tuple):
+            driver.click_at(*swatch_of(item[1]))
+            driver.wait(model.switch_sleep)
+            continue
+        for x, y in zip(item.xs, item.ys):
+            driver.click_at(*grid(x, y))
+            driver.wait(model.click_sleep)
+
+
+def test_recorded_playback_paints_every_cell_once_in_its_color():
+    qimg, mask = make_plan(16, 12, colors=5, seed=3)
+    w, h = qimg.size
+    grid = CellGrid(w, h, (100, 100), tr=(100 + (w - 1) * 6, 104), bl=(97, 100 + (h - 1) * 6))
+    swatches = {hx: (20, 40 + 15 * i) for i, hx in enumerate(qimg.palette)}
+    model = DrawCostModel(click_sleep=0.05, switch_sleep=0.2, input_pause=0.0, move_speed=0.0)
+    groups = core.PixelSet.from_indexed(qimg, mask).group_by_color()
+    sequence, predicted, _, switches, _ = plan_color_sequence(
+        groups, (w, h), "nearest", grid, swatches.get, model, regions=None)
+
+    driver = RecordingDriver()
+    play(driver, sequence, grid, swatches.get, model)
+
+    by_position = {grid(x, y): (x, y) for y in range(h) for x in range(w)}
+    by_swatch = {pos: hx for hx, pos in swatches.items()}
+    painted = {}
+    color = None
+    for x, y, _t in driver.events:
+        if (x, y) in by_swatch:
+            color = by_swatch[(x, y)]
+            continue
+        cell = by_position[(x, y)]
+        assert cell not in painted
+        painted[cell] = color
+    expected = {(x, y): qimg.hex_at(x, y) for y in range(h) for x in range(w) if mask[x, y]}
+    assert painted == expected
+    assert sum(1 for x, y, _t in driver.events if (x, y) in by_swatch) == switches
+    assert driver.clock == pytest.approx(predicted)
+    assert driver.clock == pytest.approx(predict_sequence_duration(sequence, grid, swatches.get, model))
+
+
+# --- Draw journal ---
+
+def test_journal_recovers_after_torn_record(tmp_path):
+    qimg, mask = make_plan()
+    grid = CellGrid(*qimg.size, (0, 0), br=(110, 80))
+    key = plan_key(qimg, mask, grid)
+    journal = DrawJournal(key, str(tmp_path)).open(fresh=True)
+    for i in range(300):  # crosses one fsync batch
+        journal.record(i)
+    journal.close()
+    with open(journal.path, "ab") as f:
+        f.write(b"\x07\x00")  # crash in the middle of a record
+
+    assert DrawJournal(key, str(tmp_path)).load() == set(range(300))
+    resumed = DrawJournal(key, str(tmp_path)).open()
+    resumed.record(1000)
+    resumed.close()
+    assert DrawJournal(key, str(tmp_path)).load() == set(range(300)) | {1000}
+
+
+def test_journal_ignores_other_plans(tmp_path):
+    qimg, mask = make_plan()
+    grid = CellGrid(*qimg.size, (0, 0), br=(110, 80))
+    key = plan_key(qimg, mask, grid)
+    journal = DrawJournal(key, str(tmp_path)).open(fresh=True)
+    journal.record(5)
+    journal.close()
+    other = plan_key(qimg, mask, CellGrid(*qimg.size, (1, 0), br=(111, 80)))
+    assert other != key
+    assert DrawJournal(other, str(tmp_path)).load() == set()
+
+
+# --- Calibration ---
+
+@pytest.mark.parametrize("br", [(40, 40), (20, 20), (50, 50)])
+def test_cell_grid_falls_back_to_affine_for_folded_quad(backend, br):
+    grid = CellGrid(5, 5, (0, 0), (100, 0), (0, 100), br)
+    affine = CellGrid(5, 5, (0, 0), (100, 0), (0, 100))
+    assert grid.mode == "affine"
+    assert grid.note
+    assert list(grid.xs) == list(affine.xs) and list(grid.ys) == list(affine.ys)
+
+
+def test_cell_grid_homography_hits_all_four_corners(backend):
+    tl, tr, bl, br = (10, 10), (210, 20), (0, 160), (230, 190)
+    grid = CellGrid(9, 7, tl, tr, bl, br)
+    assert grid.mode == "homography"
+    assert not grid.note
+    assert [grid(0, 0), grid(8, 0), grid(0, 6), grid(8, 6)] == [tl, tr, bl, br]
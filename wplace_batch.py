@@ -0,0 +1,171 @@
+"""Batch converter: images -> quantized drawing plans, without the GUI.
+
+    python -m wplace_batch art/ "more/**/*.png" -o plans --width 40 --limit 1600 -j 4
+
+For every image writes <name>.json (same format as "Экспорт JSON"),
+<name>.png (preview, cells scaled up) and optionally <name>.csv, fanning
+the work out to a process pool. <name> is the image's path relative to the
+folder or the fixed part of the glob it was found by, so art/a/x.png and
+art/b/x.png from "art/**/*.png" land in plans/a/x.* and plans/b/x.*.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import wplace_core
+from wplace_core import (
+    ColorIndex, ConvertOptions, DIFFUSION_KERNELS, ORDERED_DITHER_MODES, SITE_PALETTE,
+    convert_image, get_palette, read_palette_json, set_color_algorithm, set_palette,
+    write_pixels_csv, write_pixels_json,
+)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif")
+
+def _glob_root(pattern):
+    """Leading directories of a glob pattern that contain no wildcards"""
+    parts = []
+    # normpath turns "/" into "\\" on Windows, so the split sees every level
+    for part in os.path.normpath(os.path.dirname(pattern)).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts)
+
+def collect_inputs(patterns):
+    """(path, output name) for images in directories, glob patterns or plain files.
+
+    The output name is the path relative to the directory or the glob's
+    fixed prefix, without the extension. Sorted by path, unique.
+    """
+    found = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for name in os.listdir(pattern):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    found.setdefault(os.path.join(pattern, name), name)
+        elif os.path.isfile(pattern):
+            found.setdefault(pattern, os.path.basename(pattern))
+        else:
+            root = _glob_root(pattern)
+            for p in glob.glob(pattern, recursive=True):
+                if p.lower().endswith(IMAGE_EXTENSIONS):
+                    found.setdefault(p, os.path.relpath(p, root or os.curdir))
+    return sorted((p, os.path.splitext(name)[0]) for p, name in found.items())
+
+def duplicate_names(inputs):
+    """{output name: [paths]} for names that more than one input would write"""
+    by_name = {}
+    for path, name in inputs:
+        by_name.setdefault(os.path.normcase(name), []).append(path)
+    return {name: paths for name, paths in by_name.items() if len(paths) > 1}
+
+def _init_worker(palette, algorithm):
+    set_palette(palette)
+    set_color_algorithm(algorithm)
+
+def convert_file(path, out_dir, opts, preview_scale=8, write_csv=False, name=None):
+    """Convert one image and write its outputs under `name` (default: its file name)"""
+    name = name or os.path.splitext(os.path.basename(path))[0]
+    try:
+        with Image.open(path) as src:
+            result = convert_image(src, opts)
+    except Exception as e:
+        return {"path": path, "error": str(e)}
+    index = ColorIndex(result.quant, result.mask)
+    base = os.path.join(out_dir, name)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    write_pixels_json(base + ".json", index.pixels, result.quant.size)
+    if write_csv:
+        write_pixels_csv(base + ".csv", index.pixels)
+    preview = result.quant.to_image(result.mask)
+    if preview_scale > 1:
+        preview = preview.resize((preview.width * preview_scale, preview.height * preview_scale), Image.NEAREST)
+    preview.save(base + ".png")
+    w, h = result.quant.size
+    return {"path": path, "size": (w, h), "cells": len(index.pixels), "colors": len(index.histogram)}
+
+def _convert_job(args):
+    return convert_file(*args)
+
+def run_batch(inputs, out_dir, opts, jobs=None, preview_scale=8, write_csv=False, log=print):
+    """Convert (path, output name) `inputs` with a pool of `jobs` processes (1: in this process).
+
+    Returns (results, seconds). The current palette and color algorithm are
+    handed to every worker.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = [(p, out_dir, opts, preview_scale, write_csv, name) for p, name in inputs]
+    start = time.perf_counter()
+    results = []
+    if jobs == 1 or len(tasks) <= 1:
+        results = [_convert_job(t) for t in tasks]
+        for r in results:
+            log(_describe(r))
+    else:
+        workers = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(get_palette(), wplace_core.COLOR_ALGORITHM)) as pool:
+            for r in pool.map(_convert_job, tasks, chunksize=max(1, len(tasks) // (workers * 4))):
+                results.append(r)
+                log(_describe(r))
+    return results, time.perf_counter() - start
+
+def _describe(r):
+    if "error" in r:
+        return f"ОШИБКА {r['path']}: {r['error']}"
+    w, h = r["size"]
+    return f"{r['path']}: {w}x{h}, ячеек {r['cells']}, цветов {r['colors']}"
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m wplace_batch", description=__doc__.splitlines()[0])
+    ap.add_argument("inputs", nargs="+", help="папки, файлы или glob-шаблоны (** рекурсивно)")
+    ap.add_argument("-o", "--out", default="plans", help="папка результатов (по умолчанию plans)")
+    ap.add_argument("--width", type=int, default=8)
+    ap.add_argument("--height", type=int, default=8)
+    ap.add_argument("--limit", type=int, default=62, help="максимум ячеек W*H")
+    ap.add_argument("--alpha", type=int, default=10, help="порог прозрачности 0..255")
+    ap.add_argument("--bg-tol", type=int, default=12, help="допуск фона при обрезке полей")
+    ap.add_argument("--no-trim", action="store_true", help="не обрезать пустые поля")
+    ap.add_argument("--no-maximize", action="store_true", help="не подбирать максимальный размер под лимит")
+    ap.add_argument("--dither", choices=list(DIFFUSION_KERNELS) + list(ORDERED_DITHER_MODES),
+                    help="режим дизеринга (по умолчанию без дизеринга)")
+    ap.add_argument("--serpentine", action="store_true", help="змейка для диффузии ошибки")
+    ap.add_argument("--palette", help="JSON палитры ({\"palette\": [...]} или список)")
+    ap.add_argument("--algorithm", default="oklab", choices=["oklab", "deltaE", "rgb"])
+    ap.add_argument("--preview-scale", type=int, default=8, help="увеличение превью")
+    ap.add_argument("--csv", action="store_true", help="также писать CSV")
+    ap.add_argument("-j", "--jobs", type=int, default=None, help="процессов (по умолчанию по числу ядер)")
+    args = ap.parse_args(argv)
+
+    inputs = collect_inputs(args.inputs)
+    if not inputs:
+        print("Нет изображений по указанным путям", file=sys.stderr)
+        return 2
+    clashes = duplicate_names(inputs)
+    if clashes:
+        for name, paths in sorted(clashes.items()):
+            print(f"Одинаковое имя результата {name}: {', '.join(paths)}", file=sys.stderr)
+        print("Переименуйте файлы или запустите их отдельно с разными -o", file=sys.stderr)
+        return 2
+    set_palette(read_palette_json(args.palette) if args.palette else SITE_PALETTE)
+    set_color_algorithm(args.algorithm)
+    opts = ConvertOptions(
+        width=args.width, height=args.height, limit=args.limit,
+        alpha_thr=args.alpha, bg_tolerance=args.bg_tol,
+        trim=not args.no_trim, auto_maximize=not args.no_maximize,
+        dither=args.dither is not None, dither_mode=args.dither or "floyd-steinberg",
+        serpentine=args.serpentine,
+    )
+    results, seconds = run_batch(inputs, args.out, opts, args.jobs, args.preview_scale, args.csv)
+    failed = sum(1 for r in results if "error" in r)
+    rate = len(results) / seconds if seconds > 0 else float("inf")
+    print(f"Готово: {len(results)} изображений за {seconds:.2f} с ({rate:.1f} изобр./с), ошибок: {failed}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
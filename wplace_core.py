@@ -0,0 +1,2476 @@
+"""GUI-free core of Wplace Drawer: palettes, color math, quantization,
+stroke/sequence planning and the image -> plan pipeline.
+
+Used by the Tk app (wplace_drawer2.py) and the batch converter (wplace_batch.py).
+"""
+import time
+import os
+import sys
+import random
+import math
+import importlib
+import importlib.util
+from array import array
+from dataclasses import dataclass
+from collections import defaultdict
+
+# Heavy dependencies load on first use so importing the core stays cheap
+# (no numpy/Pillow/pyautogui until a function actually needs them).
+# csv, json and hashlib are likewise imported inside the few functions using them.
+class _LazyModule:
+    """Stand-in for a module, imported on first attribute access.
+
+    Once loaded it replaces itself in `namespace`, so later lookups of the
+    global go straight to the real module.
+    """
+
+    def __init__(self, name, namespace, alias):
+        self._name = name
+        self._namespace = namespace
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        self._namespace[self._alias] = module
+        return getattr(module, attr)
+
+def _optional_module(name, alias):
+    """Lazy stand-in for an optional module, or None when it isn't installed"""
+    try:
+        found = importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        found = False
+    return _LazyModule(name, globals(), alias) if found else None
+
+Image = _LazyModule("PIL.Image", globals(), "Image")
+ImageChops = _LazyModule("PIL.ImageChops", globals(), "ImageChops")
+ImageMath = _LazyModule("PIL.ImageMath", globals(), "ImageMath")
+
+# Optional: vectorized image processing
+np = _optional_module("numpy", "np")
+
+# External control: imported on first use, it probes the display and can be
+# slow or fail outright on a headless machine
+_pyautogui = None
+_pyautogui_loaded = False
+
+def get_pyautogui():
+    """pyautogui, imported on first call (None if missing or unusable)"""
+    global _pyautogui, _pyautogui_loaded
+    if not _pyautogui_loaded:
+        try:
+            import pyautogui
+            pyautogui.FAILSAFE = True  # move mouse to (0,0) to abort
+            _pyautogui = pyautogui
+        except Exception:
+            _pyautogui = None
+        _pyautogui_loaded = True
+    return _pyautogui
+
+# Enhanced site palette with better color coverage for improved matching
+SITE_PALETTE = [
+    # Extended grayscale range
+    "#000000", "#111111", "#222222", "#333333", "#444444", "#555555", 
+    "#666666", "#777777", "#888888", "#999999", "#AAAAAA", "#BBBBBB", 
+    "#CCCCCC", "#DDDDDD", "#EEEEEE", "#FFFFFF",
+    
+    # Deep reds to bright reds
+    "#4A0E11", "#6A0015", "#8B1538", "#B91C3C", "#DC2626", "#E53935", 
+    "#EF4444", "#F87171", "#FCA5A5", "#FECACA",
+    
+    # Oranges with better transitions
+    "#7C2D12", "#9A3412", "#C2410C", "#EA580C", "#F0641E", "#F97316", 
+    "#FB923C", "#FDBA74", "#FED7AA", "#FFE4C4",
+    
+    # Yellows and warm tones
+    "#A16207", "#CA8A04", "#EAB308", "#F4A300", "#FACC15", "#FDE047", 
+    "#FEF08A", "#FEFCE8", "#FFE98A", "#FFFBEB",
+    
+    # Green spectrum expanded
+    "#14532D", "#166534", "#15803D", "#16A34A", "#1E8E3E", "#22C55E", 
+    "#27AE60", "#4ADE80", "#5BE36C", "#86EFAC", "#BBF7D0", "#DCFCE7",
+    
+    # Teals and cyans
+    "#0F4C4C", "#0F766E", "#0D9488", "#0E8A6A", "#14B8A6", "#17BEBB", 
+    "#2DD4BF", "#5EEAD4", "#99F6E4", "#CCFBF1",
+    
+    # Blues comprehensive range
+    "#0C4A6E", "#075985", "#0369A1", "#0284C7", "#0096C7", "#0EA5E9", 
+    "#1E40AF", "#2563EB", "#3B82F6", "#60A5FA", "#7C83FF", "#93C5FD", 
+    "#BFDBFE", "#DBEAFE", "#7DD3FC",
+    
+    # Sky and light blues
+    "#0284C7", "#0EA5E9", "#22B8CF", "#38BDF8", "#7DD3FC", "#BAE6FD", 
+    "#E0F2FE", "#F0F9FF",
+    
+    # Purples extended
+    "#4C1D95", "#5B21B6", "#6D28D9", "#7C3AED", "#7E22CE", "#8B5CF6", 
+    "#8E44AD", "#A855F7", "#C084FC", "#D8B4FE", "#E9D5FF", "#FAF5FF",
+    
+    # Pinks and magentas
+    "#831843", "#9D174D", "#BE185D", "#C2185B", "#E91E63", "#EC4899", 
+    "#F472B6", "#F9A8D4", "#FBCFE8", "#FCE7F3",
+    
+    # Violets
+    "#6B21A8", "#7E22CE", "#8B5A96", "#9B59B6", "#A855F7", "#B794F6", 
+    "#C4A8E8", "#DDD6FE", "#EDE9FE",
+    
+    # Browns and earth tones
+    "#451A03", "#54350A", "#6B3F2C", "#78350F", "#8D5A3A", "#92400E", 
+    "#A16207", "#B45309", "#D97706", "#E6A57E", "#FBBF24",
+    
+    # Peach and coral tones
+    "#FF6B6B", "#FF8E8E", "#FFB38A", "#FFC5A3", "#FFD7BB", "#FFE9D4", 
+    "#FFF2E7", "#FFFAF5",
+    
+    # Additional useful colors
+    "#2F1B69", "#3730A3", "#4338CA", "#5147E5", "#6366F1", "#818CF8", 
+    "#A78BFA", "#C7D2FE", "#E0E7FF"
+]
+
+@dataclass
+class Pixel:
+    # view of one PixelSet cell; slots keep it cheap when iterating
+    __slots__ = ("x", "y", "hex_color")
+    x: int
+    y: int
+    hex_color: str
+
+def rgb_to_hex(rgb):
+    r, g, b = rgb[:3]
+    return f"#{r:02X}{g:02X}{b:02X}"
+
+def hex_to_rgb(hx: str):
+    hx = hx.lstrip('#')
+    return tuple(int(hx[i:i+2], 16) for i in (0, 2, 4))
+
+# --- Color science helpers (OKLab) for perceptual distance ---
+# Reference: https://bottosson.github.io/posts/oklab/
+
+def _srgb_channel_to_linear(c: float) -> float:
+    c = c / 255.0
+    if c <= 0.04045:
+        return c / 12.92
+    return ((c + 0.055) / 1.055) ** 2.4
+
+# sRGB transfer function precomputed for every 8-bit channel value
+_SRGB_TO_LINEAR = tuple(_srgb_channel_to_linear(v) for v in range(256))
+
+# Linear sRGB -> LMS and LMS' -> OKLab matrices
+_OKLAB_M1 = (
+    (0.4122214708, 0.5363325363, 0.0514459929),
+    (0.2119034982, 0.6806995451, 0.1073969566),
+    (0.0883024619, 0.2817188376, 0.6299787005),
+)
+_OKLAB_M2 = (
+    (0.2104542553, 0.7936177850, -0.0040720468),
+    (1.9779984951, -2.4285922050, 0.4505937099),
+    (0.0259040371, 0.7827717662, -0.8086757660),
+)
+# Linear sRGB -> XYZ (D65) and the D65 reference white (2° observer)
+_XYZ_M = (
+    (0.4124564, 0.3575761, 0.1804375),
+    (0.2126729, 0.7151522, 0.0721750),
+    (0.0193339, 0.1191920, 0.9503041),
+)
+_D65_WHITE = (0.95047, 1.00000, 1.08883)
+
+def _srgb_to_linear(c: float) -> float:
+    if isinstance(c, int) and 0 <= c <= 255:
+        return _SRGB_TO_LINEAR[c]
+    return _srgb_channel_to_linear(c)
+
+def _linear_to_oklab(r: float, g: float, b: float):
+    # r,g,b are linear [0..1]
+    (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = _OKLAB_M1
+    l = m00 * r + m01 * g + m02 * b
+    m = m10 * r + m11 * g + m12 * b
+    s = m20 * r + m21 * g + m22 * b
+    l_ = l ** (1/3)
+    m_ = m ** (1/3)
+    s_ = s ** (1/3)
+    (n00, n01, n02), (n10, n11, n12), (n20, n21, n22) = _OKLAB_M2
+    L = n00 * l_ + n01 * m_ + n02 * s_
+    a = n10 * l_ + n11 * m_ + n12 * s_
+    b2 = n20 * l_ + n21 * m_ + n22 * s_
+    return (L, a, b2)
+
+def _rgb_to_oklab(r: int, g: int, b: int):
+    rl = _srgb_to_linear(r)
+    gl = _srgb_to_linear(g)
+    bl = _srgb_to_linear(b)
+    return _linear_to_oklab(rl, gl, bl)
+
+def _oklab_dist(c1, c2):
+    dL = c1[0] - c2[0]
+    da = c1[1] - c2[1]
+    db = c1[2] - c2[2]
+    return dL*dL + da*da + db*db
+
+# --- Additional color distance algorithms ---
+
+def _rgb_euclidean_distance(c1, c2):
+    """Simple RGB Euclidean distance"""
+    dr = c1[0] - c2[0]
+    dg = c1[1] - c2[1]
+    db = c1[2] - c2[2]
+    return dr*dr + dg*dg + db*db
+
+def _lab_f(t):
+    return t**(1/3) if t > 0.008856 else (7.787 * t + 16/116)
+
+def _xyz_to_lab(x, y, z):
+    """Convert XYZ to Lab color space for Delta E CIE76"""
+    # Observer: 2°, Illuminant: D65
+    xn, yn, zn = _D65_WHITE
+    fx = _lab_f(x / xn)
+    fy = _lab_f(y / yn)
+    fz = _lab_f(z / zn)
+    
+    L = 116 * fy - 16
+    a = 500 * (fx - fy)
+    b = 200 * (fy - fz)
+    
+    return L, a, b
+
+def _rgb_to_xyz(r, g, b):
+    """Convert RGB to XYZ color space"""
+    # Gamma correction via the sRGB table
+    r = _srgb_to_linear(r)
+    g = _srgb_to_linear(g)
+    b = _srgb_to_linear(b)
+    
+    # Convert to XYZ using sRGB matrix
+    (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = _XYZ_M
+    x = r * m00 + g * m01 + b * m02
+    y = r * m10 + g * m11 + b * m12
+    z = r * m20 + g * m21 + b * m22
+    
+    return x, y, z
+
+def _rgb_to_lab(r, g, b):
+    """Convert RGB to Lab color space"""
+    x, y, z = _rgb_to_xyz(r, g, b)
+    return _xyz_to_lab(x, y, z)
+
+def _delta_e_cie76(lab1, lab2):
+    """Delta E CIE76 color difference"""
+    dL = lab1[0] - lab2[0]
+    da = lab1[1] - lab2[1]
+    db = lab1[2] - lab2[2]
+    return (dL*dL + da*da + db*db) ** 0.5
+
+# --- Batch color conversion ---
+# Converts many colors at once. With NumPy, (N, 3) uint8 arrays go through
+# the sRGB table by fancy indexing and the matrices as one matmul each;
+# without it, sequences of tuples are converted in a plain loop.
+
+_SRGB_TO_LINEAR_NP = None
+
+def _linear_table_np():
+    global _SRGB_TO_LINEAR_NP
+    if _SRGB_TO_LINEAR_NP is None:
+        _SRGB_TO_LINEAR_NP = np.array(_SRGB_TO_LINEAR, dtype=np.float64)
+    return _SRGB_TO_LINEAR_NP
+
+def _oklab_batch_np(rgb):
+    lin = _linear_table_np()[rgb]
+    return np.cbrt(lin @ np.array(_OKLAB_M1).T) @ np.array(_OKLAB_M2).T
+
+def _lab_batch_np(rgb):
+    lin = _linear_table_np()[rgb]
+    xyz = (lin @ np.array(_XYZ_M).T) / np.array(_D65_WHITE)
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    return np.stack([
+        116 * f[:, 1] - 16,
+        500 * (f[:, 0] - f[:, 1]),
+        200 * (f[:, 1] - f[:, 2]),
+    ], axis=1)
+
+def _is_ndarray(x):
+    # no ndarray can exist before numpy is imported, so don't import it to check
+    return np is not None and "numpy" in sys.modules and isinstance(x, np.ndarray)
+
+def rgb_to_oklab_batch(rgb):
+    """OKLab for many colors: (N, 3) uint8 array -> float array, or tuples -> list"""
+    if _is_ndarray(rgb):
+        return _oklab_batch_np(rgb.reshape(-1, 3))
+    return [_rgb_to_oklab(*c[:3]) for c in rgb]
+
+def rgb_to_lab_batch(rgb):
+    """CIELab for many colors: (N, 3) uint8 array -> float array, or tuples -> list"""
+    if _is_ndarray(rgb):
+        return _lab_batch_np(rgb.reshape(-1, 3))
+    return [_rgb_to_lab(*c[:3]) for c in rgb]
+
+def rgb_to_space_batch(rgb, algorithm):
+    """Coordinates of many colors in the metric space of `algorithm`"""
+    if algorithm == "oklab":
+        return rgb_to_oklab_batch(rgb)
+    if algorithm == "deltaE":
+        return rgb_to_lab_batch(rgb)
+    if _is_ndarray(rgb):
+        return rgb.reshape(-1, 3).astype(np.float64)
+    return [tuple(c[:3]) for c in rgb]
+
+# --- Inverse conversions (cluster centers back to sRGB) ---
+
+def _linear_to_srgb8(c: float) -> int:
+    c = min(1.0, max(0.0, c))
+    if c <= 0.0031308:
+        v = 12.92 * c
+    else:
+        v = 1.055 * c ** (1 / 2.4) - 0.055
+    return int(round(v * 255))
+
+def _oklab_to_rgb(L, a, b):
+    l_ = L + 0.3963377774 * a + 0.2158037573 * b
+    m_ = L - 0.1055613458 * a - 0.0638541728 * b
+    s_ = L - 0.0894841775 * a - 1.2914855480 * b
+    l, m, s = l_ ** 3, m_ ** 3, s_ ** 3
+    return (
+        _linear_to_srgb8(4.0767416621 * l - 3.3077115913 * m + 0.2309699292 * s),
+        _linear_to_srgb8(-1.2684380046 * l + 2.6097574011 * m - 0.3413193965 * s),
+        _linear_to_srgb8(-0.0041960863 * l - 0.7034186147 * m + 1.7076147010 * s),
+    )
+
+def _lab_to_rgb(L, a, b):
+    fy = (L + 16) / 116
+    fx = fy + a / 500
+    fz = fy - b / 200
+    def finv(t):
+        t3 = t ** 3
+        return t3 if t3 > 0.008856 else (t - 16 / 116) / 7.787
+    x = finv(fx) * _D65_WHITE[0]
+    y = finv(fy) * _D65_WHITE[1]
+    z = finv(fz) * _D65_WHITE[2]
+    return (
+        _linear_to_srgb8(3.2404542 * x - 1.5371385 * y - 0.4985314 * z),
+        _linear_to_srgb8(-0.9692660 * x + 1.8760108 * y + 0.0415560 * z),
+        _linear_to_srgb8(0.0556434 * x - 0.2040259 * y + 1.0572252 * z),
+    )
+
+def space_to_rgb(p, algorithm):
+    """Inverse of rgb_to_space_batch for a single point, clamped to 8-bit sRGB"""
+    if algorithm == "oklab":
+        return _oklab_to_rgb(*p)
+    if algorithm == "deltaE":
+        return _lab_to_rgb(*p)
+    return tuple(min(255, max(0, int(round(v)))) for v in p)
+
+# Color distance algorithm globals
+COLOR_ALGORITHM = "oklab"  # options: "oklab", "deltaE", "rgb"
+
+# Current palette (mutable) and precomputed arrays
+CURRENT_PALETTE = list(SITE_PALETTE)
+_PALETTE_RGB = [hex_to_rgb(hx) for hx in CURRENT_PALETTE]
+_PALETTE_SPACES = {}  # algorithm -> palette coordinates, converted on first use
+
+def set_palette(hex_list):
+    global CURRENT_PALETTE, _PALETTE_RGB
+    # sanitize and unique while preserving order
+    seen = set()
+    cleaned = []
+    for hx in hex_list:
+        if not isinstance(hx, str):
+            continue
+        if not hx.startswith('#'):
+            hx = '#' + hx
+        hx = hx[:7].upper()
+        if len(hx) != 7:
+            continue
+        if hx in seen:
+            continue
+        seen.add(hx)
+        cleaned.append(hx)
+    if cleaned:
+        CURRENT_PALETTE = cleaned
+        _PALETTE_RGB = [hex_to_rgb(hx) for hx in CURRENT_PALETTE]
+        _PALETTE_SPACES.clear()
+        _invalidate_palette_index()
+
+def get_palette():
+    return list(CURRENT_PALETTE)
+
+def set_color_algorithm(algorithm: str):
+    """Set the color distance algorithm to use"""
+    global COLOR_ALGORITHM
+    if algorithm in ["oklab", "deltaE", "rgb"]:
+        if algorithm != COLOR_ALGORITHM:
+            COLOR_ALGORITHM = algorithm
+            _invalidate_palette_index()
+
+def _palette_space(algorithm):
+    """Return (converter, palette coordinates) for the given algorithm.
+
+    All three metrics are monotonic in the squared Euclidean distance of
+    their space, so the nearest-color search can share one loop.
+    """
+    if algorithm == "oklab":
+        convert, batch = _rgb_to_oklab, rgb_to_oklab_batch
+    elif algorithm == "deltaE":
+        convert, batch = _rgb_to_lab, rgb_to_lab_batch
+    else:
+        return None, _PALETTE_RGB
+    coords = _PALETTE_SPACES.get(algorithm)
+    if coords is None:
+        coords = _PALETTE_SPACES[algorithm] = batch(_PALETTE_RGB)
+    return convert, coords
+
+def _to_space(convert, r, g, b):
+    return convert(r, g, b) if convert is not None else (r, g, b)
+
+def nearest_palette_index(r: int, g: int, b: int) -> int:
+    """Index in CURRENT_PALETTE of the closest color (exact search)"""
+    convert, _ = _palette_space(COLOR_ALGORITHM)
+    return get_palette_index().nearest(_to_space(convert, r, g, b))
+
+def nearest_palette_color(r: int, g: int, b: int) -> str:
+    """Find the closest palette color using the selected algorithm"""
+    return CURRENT_PALETTE[nearest_palette_index(r, g, b)]
+
+# --- Palette spatial index ---
+_QUANT_BLOCK = 1 << 20  # distance matrix entries per NumPy chunk
+_GRID_MIN_PALETTE = 128  # below this a brute-force batch scan is cheaper
+
+class PaletteIndex:
+    """Nearest-neighbor index over palette coordinates in one metric space.
+
+    Single lookups walk a k-d tree with small leaf buckets. Batches (NumPy)
+    go through a bucket grid over the query points where every cell keeps
+    only the palette entries that can be nearest to something inside it.
+    Ties resolve to the lowest palette index, like a linear scan.
+    """
+
+    LEAF_SIZE = 8
+
+    def __init__(self, coords):
+        self.coords = tuple(tuple(float(v) for v in c) for c in coords)
+        self._root = self._build(list(range(len(self.coords))))
+        self._coords_np = None
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _build(self, ids):
+        if len(ids) <= self.LEAF_SIZE:
+            return sorted(ids)
+        pts = self.coords
+        spans = [max(pts[i][k] for i in ids) - min(pts[i][k] for i in ids) for k in range(3)]
+        axis = spans.index(max(spans))
+        ids.sort(key=lambda i: pts[i][axis])
+        mid = len(ids) // 2
+        return (axis, pts[ids[mid]][axis], self._build(ids[:mid]), self._build(ids[mid:]))
+
+    def nearest(self, p):
+        """Index of the entry closest to point `p` (squared Euclidean)"""
+        p0, p1, p2 = p
+        coords = self.coords
+        best_i = -1
+        best_d = float("inf")
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound > best_d:
+                continue
+            if type(node) is list:
+                for i in node:
+                    c = coords[i]
+                    d0 = p0 - c[0]
+                    d1 = p1 - c[1]
+                    d2 = p2 - c[2]
+                    d = d0*d0 + d1*d1 + d2*d2
+                    if d < best_d or (d == best_d and i < best_i):
+                        best_d = d
+                        best_i = i
+                continue
+            axis, split, lo, hi = node
+            diff = p[axis] - split
+            # far side first so the near side is popped (and searched) first
+            if diff < 0:
+                stack.append((hi, diff * diff))
+                stack.append((lo, bound))
+            else:
+                stack.append((lo, diff * diff))
+                stack.append((hi, bound))
+        return best_i
+
+    def _pal_np(self):
+        if self._coords_np is None:
+            self._coords_np = np.array(self.coords, dtype=np.float64).reshape(-1, 3)
+        return self._coords_np
+
+    def nearest_batch(self, pts):
+        """Nearest entry for every row of an (N, 3) float array (NumPy)"""
+        pal = self._pal_np()
+        out = np.empty(len(pts), dtype=np.intp)
+        if len(pts) == 0:
+            return out
+        if len(pal) <= _GRID_MIN_PALETTE:
+            pal_sq = (pal * pal).sum(axis=1)
+            rows = max(1, _QUANT_BLOCK // len(pal))
+            for start in range(0, len(pts), rows):
+                chunk = pts[start:start + rows]
+                # |x - p|^2 without the |x|^2 term, which does not change the argmin
+                d = pal_sq[None, :] - 2.0 * (chunk @ pal.T)
+                out[start:start + rows] = d.argmin(axis=1)
+            return out
+        pal_sq = (pal * pal).sum(axis=1)
+        cells, ok = self._grid_candidates(pts)
+        order = np.argsort(cells, kind="stable")
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=len(ok)))))
+        for c in range(len(ok)):
+            sel = order[bounds[c]:bounds[c + 1]]
+            cand = np.flatnonzero(ok[c])  # ascending, so argmin keeps the lowest index on ties
+            d = pal_sq[cand][None, :] - 2.0 * (pts[sel] @ pal[cand].T)
+            out[sel] = cand[d.argmin(axis=1)]
+        return out
+
+    def _grid_candidates(self, pts):
+        """Bucket the query points; return (cell of each point, cell x entry candidate mask).
+
+        For a box with center c and half-diagonal r, every point inside is
+        within |c - p*| + r of the entry p* nearest to c, so only entries
+        with |c - p| <= |c - p*| + 2r can be nearest to any of its points.
+        """
+        pal = self._pal_np()
+        side = max(2, min(24, int(round(3 * len(pal) ** (1 / 3)))))
+        lo = pts.min(axis=0)
+        size = (pts.max(axis=0) - lo) / side
+        size[size == 0] = 1e-9
+        cell3 = np.minimum(((pts - lo) / size).astype(np.intp), side - 1)
+        flat = (cell3[:, 0] * side + cell3[:, 1]) * side + cell3[:, 2]
+        occupied, cells = np.unique(flat, return_inverse=True)
+        occ3 = np.stack([occupied // (side * side), (occupied // side) % side, occupied % side], axis=1)
+        centers = lo + (occ3 + 0.5) * size
+        half_diag = 0.5 * float(np.sqrt((size * size).sum()))
+        pal_sq = (pal * pal).sum(axis=1)
+        ok = np.empty((len(occupied), len(pal)), dtype=bool)
+        rows = max(1, _QUANT_BLOCK // len(pal))
+        for start in range(0, len(occupied), rows):
+            c = centers[start:start + rows]
+            d2 = (c * c).sum(axis=1)[:, None] + pal_sq[None, :] - 2.0 * (c @ pal.T)
+            d = np.sqrt(np.maximum(d2, 0.0))
+            # small slack absorbs rounding in the expanded-square distances
+            limit = d.min(axis=1) + 2.0 * half_diag + 1e-6 * (1.0 + d.max(axis=1))
+            ok[start:start + rows] = d <= limit[:, None]
+        return cells.reshape(-1), ok
+
+_PALETTE_INDEX = None
+
+def _invalidate_palette_index():
+    """Drop the index and LUT; both are rebuilt on next use"""
+    global _PALETTE_INDEX
+    _PALETTE_INDEX = None
+    _invalidate_palette_lut()
+
+def get_palette_index() -> PaletteIndex:
+    """Spatial index of the current palette in the active color space"""
+    global _PALETTE_INDEX
+    if _PALETTE_INDEX is None:
+        _, coords = _palette_space(COLOR_ALGORITHM)
+        _PALETTE_INDEX = PaletteIndex(coords)
+    return _PALETTE_INDEX
+
+# --- Palette lookup table ---
+# RGB space is split into 32x32x32 cells. A cell whose 8 corners map to the
+# same palette entry resolves with a single table read; cells on a boundary
+# between palette entries fall back to the exact search (memoized per color).
+# For "rgb" the nearest-color regions are convex, so the table is exact; for
+# OKLab/Lab the regions are smooth enough at this cell size.
+_LUT_BITS = 5
+_LUT_SIDE = 1 << _LUT_BITS
+_LUT_SHIFT = 8 - _LUT_BITS
+_LUT_UNSET = 0xFFFF
+_LUT_MIXED = 0xFFFE
+
+class PaletteLUT:
+    """Lazily filled RGB -> palette index table for one palette/algorithm"""
+
+    def __init__(self, palette, algorithm, index):
+        self.key = (tuple(palette), algorithm)
+        self.palette = tuple(palette)
+        self.rgb = tuple(hex_to_rgb(hx) for hx in self.palette)
+        self.palette_index = index
+        self._convert, _ = _palette_space(algorithm)
+        self._cells = array('H', [_LUT_UNSET]) * (_LUT_SIDE ** 3)
+        self._corners = array('H', [_LUT_UNSET]) * ((_LUT_SIDE + 1) ** 3)
+        self._exact = {}
+        self._filled = False
+
+    def nearest(self, r, g, b):
+        return self.palette_index.nearest(_to_space(self._convert, r, g, b))
+
+    def prefill(self):
+        """Fill the whole table at once with NumPy (no-op without it or when done)"""
+        if np is None or self._filled:
+            return
+        n = _LUT_SIDE + 1
+        levels = np.minimum(np.arange(n) << _LUT_SHIFT, 255).astype(np.uint8)
+        grid = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).reshape(-1, 3)
+        corners = nearest_palette_indices(grid, self).reshape(n, n, n)
+        first = corners[:-1, :-1, :-1]
+        uniform = np.ones(first.shape, dtype=bool)
+        for di in (0, 1):
+            for dj in (0, 1):
+                for dk in (0, 1):
+                    uniform &= corners[di:n - 1 + di, dj:n - 1 + dj, dk:n - 1 + dk] == first
+        self._corners = array('H', corners.astype(np.uint16).tobytes())
+        self._cells = array('H', np.where(uniform, first, _LUT_MIXED).astype(np.uint16).tobytes())
+        self._filled = True
+
+    def _corner(self, i, j, k):
+        ci = (i * (_LUT_SIDE + 1) + j) * (_LUT_SIDE + 1) + k
+        v = self._corners[ci]
+        if v == _LUT_UNSET:
+            step = 1 << _LUT_SHIFT
+            v = self.nearest(min(255, i * step), min(255, j * step), min(255, k * step))
+            self._corners[ci] = v
+        return v
+
+    def _fill_cell(self, i, j, k, ci):
+        first = self._corner(i, j, k)
+        uniform = all(
+            self._corner(i + di, j + dj, k + dk) == first
+            for di in (0, 1) for dj in (0, 1) for dk in (0, 1)
+        )
+        v = first if uniform else _LUT_MIXED
+        self._cells[ci] = v
+        return v
+
+    def index(self, r, g, b):
+        """Palette index for an RGB triple (0..255 ints)"""
+        i, j, k = r >> _LUT_SHIFT, g >> _LUT_SHIFT, b >> _LUT_SHIFT
+        ci = (i << (2 * _LUT_BITS)) | (j << _LUT_BITS) | k
+        v = self._cells[ci]
+        if v == _LUT_UNSET:
+            v = self._fill_cell(i, j, k, ci)
+        if v != _LUT_MIXED:
+            return v
+        key = (r << 16) | (g << 8) | b
+        v = self._exact.get(key)
+        if v is None:
+            v = self._exact[key] = self.nearest(r, g, b)
+        return v
+
+_PALETTE_LUT = None
+
+def _invalidate_palette_lut():
+    global _PALETTE_LUT
+    _PALETTE_LUT = None
+
+def get_palette_lut() -> PaletteLUT:
+    """Lookup table for the current palette and algorithm (built on demand)"""
+    global _PALETTE_LUT
+    key = (tuple(CURRENT_PALETTE), COLOR_ALGORITHM)
+    if _PALETTE_LUT is None or _PALETTE_LUT.key != key:
+        _PALETTE_LUT = PaletteLUT(CURRENT_PALETTE, COLOR_ALGORITHM, get_palette_index())
+    return _PALETTE_LUT
+
+# --- Quantization results ---
+_POPCOUNT = bytes(bin(i).count("1") for i in range(256))
+
+class DrawMask:
+    """Bit-packed draw mask, one bit per cell (set -> draw, clear -> skip).
+
+    Rows are padded to whole bytes, most significant bit first, which is
+    the raw layout of a Pillow "1" image.
+    """
+
+    __slots__ = ("width", "height", "stride", "bits")
+
+    def __init__(self, width, height, bits=None):
+        self.width = width
+        self.height = height
+        self.stride = (width + 7) // 8
+        self.bits = bytearray(bits) if bits is not None else bytearray(self.stride * height)
+
+    @classmethod
+    def from_flags(cls, flags, width, height):
+        """Pack a row-major sequence of 0/1 flags"""
+        if np is not None:
+            grid = np.frombuffer(bytes(flags), dtype=np.uint8).reshape(height, width)
+            return cls(width, height, np.packbits(grid, axis=1).tobytes())
+        mask = cls(width, height)
+        bits, stride = mask.bits, mask.stride
+        for y in range(height):
+            row = flags[y * width:(y + 1) * width]
+            for bx in range(0, width, 8):
+                v = 0
+                for k, f in enumerate(row[bx:bx + 8]):
+                    if f:
+                        v |= 0x80 >> k
+                bits[y * stride + (bx >> 3)] = v
+        return mask
+
+    def __getitem__(self, xy):
+        x, y = xy
+        return bool(self.bits[y * self.stride + (x >> 3)] & (0x80 >> (x & 7)))
+
+    def flags(self):
+        """Unpacked row-major 0/1 flags as a bytearray"""
+        w, h = self.width, self.height
+        if np is not None:
+            grid = np.unpackbits(np.frombuffer(bytes(self.bits), dtype=np.uint8).reshape(h, self.stride), axis=1)
+            return bytearray(grid[:, :w].tobytes())
+        out = bytearray(w * h)
+        for y in range(h):
+            for x in range(w):
+                if self[x, y]:
+                    out[y * w + x] = 1
+        return out
+
+    def count(self):
+        """Number of cells to draw"""
+        return sum(_POPCOUNT[b] for b in self.bits)
+
+    def to_image(self):
+        return Image.frombytes("1", (self.width, self.height), bytes(self.bits))
+
+    def crop(self, box, step=1):
+        """Mask of the cells in box = (x0, y0, x1, y1), every `step`-th one"""
+        x0, y0, x1, y1 = box
+        if step == 1:
+            rows = Image.frombytes("1", (self.width, y1 - y0), bytes(self.bits[y0 * self.stride:y1 * self.stride]))
+            return DrawMask(x1 - x0, y1 - y0, rows.crop((x0, 0, x1, y1 - y0)).tobytes())
+        xs = range(x0, x1, step)
+        ys = range(y0, y1, step)
+        return DrawMask.from_flags(bytearray(1 if self[x, y] else 0 for y in ys for x in xs), len(xs), len(ys))
+
+class IndexedImage:
+    """Quantized grid: one palette index per cell plus the palette it refers to.
+
+    Indices are uint8 when the palette fits in 256 entries, uint16 otherwise.
+    Hex strings are looked up from `palette` only where needed (UI, export).
+    """
+
+    __slots__ = ("size", "palette", "indices")
+
+    def __init__(self, size, palette, indices):
+        self.size = tuple(size)
+        self.palette = tuple(palette)
+        if len(self.palette) <= 256 and getattr(indices, "typecode", None) != 'B':
+            indices = array('B', indices)
+        self.indices = indices
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def index_at(self, x, y):
+        return self.indices[y * self.size[0] + x]
+
+    def hex_at(self, x, y):
+        return self.palette[self.index_at(x, y)]
+
+    def palette_index(self, hx):
+        """Index of a hex color in this image's palette, or None"""
+        try:
+            return self.palette.index(hx.upper())
+        except ValueError:
+            return None
+
+    def crop(self, box, step=1):
+        """Sub-grid of the cells in box = (x0, y0, x1, y1), every `step`-th one"""
+        x0, y0, x1, y1 = box
+        w = self.size[0]
+        out = array(self.indices.typecode)
+        for y in range(y0, y1, step):
+            out.extend(self.indices[y * w + x0:y * w + x1:step])
+        return IndexedImage((len(range(x0, x1, step)), len(range(y0, y1, step))), self.palette, out)
+
+    def color_mask(self, index):
+        """"L" image, 255 on cells holding palette entry `index`"""
+        if self.indices.typecode == 'B':
+            lut = [255 if i == index else 0 for i in range(256)]
+            return Image.frombytes("L", self.size, self.indices.tobytes()).point(lut)
+        if np is not None:
+            idx = np.frombuffer(self.indices.tobytes(), dtype=np.uint16)
+            return Image.frombytes("L", self.size, ((idx == index) * 255).astype(np.uint8).tobytes())
+        return Image.frombytes("L", self.size, bytes(255 if i == index else 0 for i in self.indices))
+
+    def to_image(self, mask=None, transparent_bg=(235, 235, 235)):
+        """Render to an RGB Pillow image; cells outside `mask` get `transparent_bg`"""
+        rgb = [hex_to_rgb(hx) for hx in self.palette]
+        if self.indices.typecode == 'B':
+            img = Image.frombytes("P", self.size, self.indices.tobytes())
+            img.putpalette([c for px in rgb for c in px])
+            img = img.convert("RGB")
+        elif np is not None:
+            w, h = self.size
+            idx = np.frombuffer(self.indices.tobytes(), dtype=np.uint16)
+            img = Image.fromarray(np.array(rgb, dtype=np.uint8)[idx].reshape(h, w, 3))
+        else:
+            img = Image.new("RGB", self.size)
+            img.putdata([rgb[i] for i in self.indices])
+        if mask is not None:
+            img = Image.composite(img, Image.new("RGB", self.size, transparent_bg), mask.to_image())
+        return img
+
+class PixelSet:
+    """Drawable cells as parallel columns: x, y and palette index.
+
+    Columns are compact arrays (uint16 coordinates, uint8 color indices, or
+    uint16 for palettes over 256 colors). Iterating yields Pixel views for
+    code that wants objects; hot paths should read the columns directly.
+    """
+
+    __slots__ = ("palette", "xs", "ys", "colors")
+
+    def __init__(self, palette, xs=None, ys=None, colors=None):
+        self.palette = tuple(palette)
+        self.xs = xs if xs is not None else array('H')
+        self.ys = ys if ys is not None else array('H')
+        if colors is None:
+            colors = array('B' if len(self.palette) <= 256 else 'H')
+        self.colors = colors
+
+    @classmethod
+    def from_indexed(cls, qimg, mask=None):
+        """All cells of an IndexedImage that are set in `mask`, row-major"""
+        w, h = qimg.size
+        typecode = qimg.indices.typecode
+        if np is not None:
+            idx = np.frombuffer(qimg.indices.tobytes(), dtype=np.uint8 if typecode == 'B' else np.uint16)
+            if mask is not None:
+                pos = np.flatnonzero(np.frombuffer(bytes(mask.flags()), dtype=np.uint8))
+            else:
+                pos = np.arange(w * h)
+            return cls(
+                qimg.palette,
+                array('H', (pos % w).astype(np.uint16).tobytes()),
+                array('H', (pos // w).astype(np.uint16).tobytes()),
+                array(typecode, idx[pos].tobytes()),
+            )
+        out = cls(qimg.palette, colors=array(typecode))
+        flags = mask.flags() if mask is not None else None
+        for i, c in enumerate(qimg.indices):
+            if flags is None or flags[i]:
+                out.append(i % w, i // w, c)
+        return out
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __iter__(self):
+        palette = self.palette
+        for x, y, c in zip(self.xs, self.ys, self.colors):
+            yield Pixel(x, y, palette[c])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PixelSet(self.palette, self.xs[i], self.ys[i], self.colors[i])
+        return Pixel(self.xs[i], self.ys[i], self.palette[self.colors[i]])
+
+    def take(self, order):
+        """New PixelSet with the cells in the given index order"""
+        xs, ys, colors = self.xs, self.ys, self.colors
+        return PixelSet(
+            self.palette,
+            array('H', [xs[i] for i in order]),
+            array('H', [ys[i] for i in order]),
+            array(colors.typecode, [colors[i] for i in order]),
+        )
+
+    def append(self, x, y, color):
+        self.xs.append(x)
+        self.ys.append(y)
+        self.colors.append(color)
+
+    def group_by_color(self):
+        """Split into {hex: PixelSet}, keeping the original order inside each color"""
+        groups = {}
+        if np is not None and len(self):
+            colors = np.frombuffer(self.colors.tobytes(), dtype=np.uint8 if self.colors.typecode == 'B' else np.uint16)
+            xs = np.frombuffer(self.xs.tobytes(), dtype=np.uint16)
+            ys = np.frombuffer(self.ys.tobytes(), dtype=np.uint16)
+            order = np.argsort(colors, kind="stable")
+            values, starts = np.unique(colors[order], return_index=True)
+            ends = list(starts[1:]) + [len(order)]
+            for c, a, b in zip(values.tolist(), starts.tolist(), ends):
+                sel = order[a:b]
+                groups[self.palette[c]] = PixelSet(
+                    self.palette,
+                    array('H', xs[sel].tobytes()),
+                    array('H', ys[sel].tobytes()),
+                    array(self.colors.typecode, colors[sel].tobytes()),
+                )
+            return groups
+        by_index = {}
+        for x, y, c in zip(self.xs, self.ys, self.colors):
+            ps = by_index.get(c)
+            if ps is None:
+                ps = by_index[c] = PixelSet(self.palette, colors=array(self.colors.typecode))
+            ps.append(x, y, c)
+        return {self.palette[c]: ps for c, ps in by_index.items()}
+
+class ColorIndex:
+    """Per-color view of one quantization result, built once and reused.
+
+    Holds every drawable cell (`pixels`), the cells of each color
+    (`groups`, hex -> PixelSet) and the histogram sorted by count.
+    """
+
+    __slots__ = ("pixels", "groups", "histogram")
+
+    def __init__(self, qimg, mask=None):
+        self.pixels = PixelSet.from_indexed(qimg, mask)
+        self.groups = self.pixels.group_by_color()
+        self.histogram = sorted(
+            ((hx, len(ps)) for hx, ps in self.groups.items()),
+            key=lambda kv: kv[1], reverse=True,
+        )
+
+    def count(self, hx):
+        ps = self.groups.get(hx.upper())
+        return len(ps) if ps is not None else 0
+
+    def cells(self, hx):
+        """PixelSet of one color (empty if the color is not used)"""
+        ps = self.groups.get(hx.upper())
+        return ps if ps is not None else PixelSet(self.pixels.palette)
+
+# --- Preview rendering ---
+PREVIEW_GRID_MIN_SCALE = 3  # below this the grid lines would hide the cells
+
+def _cell_pattern(size, scale, offsets):
+    """"L" image set where a pixel's in-cell x or y offset is in `offsets`"""
+    w, h = size
+    cols = Image.frombytes("L", (w, 1), bytes(255 if x % scale in offsets else 0 for x in range(w)))
+    rows = Image.frombytes("L", (1, h), bytes(255 if y % scale in offsets else 0 for y in range(h)))
+    return ImageChops.lighter(cols.resize(size, Image.NEAREST), rows.resize(size, Image.NEAREST))
+
+def render_preview(qimg, mask=None, scale=1, highlight=None, transparent_bg=(235, 235, 235),
+                   grid_color=(68, 68, 68), highlight_color=(255, 238, 0)):
+    """Preview of a quantized grid as one RGB image, `scale` px per cell.
+
+    From PREVIEW_GRID_MIN_SCALE up, grid lines run along the top/left edge
+    of every cell and the image gets one extra closing row and column.
+    Cells of the `highlight` hex color get an outline max(1, scale // 6)
+    px wide (a fill when that covers the cell). Everything is composed
+    with Pillow operations, no per-cell drawing calls.
+    """
+    w, h = qimg.size
+    size = (w * scale, h * scale)
+    img = qimg.to_image(mask, transparent_bg).resize(size, Image.NEAREST)
+    grid = scale >= PREVIEW_GRID_MIN_SCALE
+    if grid:
+        img.paste(grid_color, (0, 0) + size, _cell_pattern(size, scale, {0}))
+    k = qimg.palette_index(highlight) if highlight else None
+    if k is not None:
+        cells = qimg.color_mask(k)
+        if mask is not None:
+            cells = ImageChops.darker(cells, mask.to_image().convert("L"))
+        cells = cells.resize(size, Image.NEAREST)
+        lw = max(1, scale // 6)
+        ring = set(range(lw)) | set(range(scale - lw, scale))
+        if len(ring) < scale:
+            cells = ImageChops.darker(cells, _cell_pattern(size, scale, ring))
+        img.paste(highlight_color, (0, 0) + size, cells)
+    if grid:
+        framed = Image.new("RGB", (size[0] + 1, size[1] + 1), grid_color)
+        framed.paste(img, (0, 0))
+        img = framed
+    return img
+
+# Preview zoom levels, screen px per cell: below 1 every n-th cell is sampled
+ZOOM_LEVELS = (1 / 16, 1 / 8, 1 / 4, 1 / 2, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64)
+
+def render_preview_region(qimg, mask, box, zoom, highlight=None, transparent_bg=(235, 235, 235)):
+    """render_preview of the cells in `box` at `zoom` px per cell.
+
+    `zoom` is an integer, or 1/n to sample every n-th cell, so the work is
+    bounded by the output size rather than the grid. The closing grid line
+    is kept only where the box reaches the grid's right/bottom edge, so
+    adjacent regions tile without doubled lines.
+    """
+    if zoom >= 1:
+        step, scale = 1, int(zoom)
+    else:
+        step, scale = int(round(1 / zoom)), 1
+    sub = qimg.crop(box, step)
+    img = render_preview(sub, mask.crop(box, step) if mask is not None else None, scale, highlight,
+                         transparent_bg)
+    closing = 1 if scale >= PREVIEW_GRID_MIN_SCALE else 0
+    w = sub.width * scale + (closing if box[2] >= qimg.width else 0)
+    h = sub.height * scale + (closing if box[3] >= qimg.height else 0)
+    return img if img.size == (w, h) else img.crop((0, 0, w, h))
+
+# --- Vectorized quantization (NumPy) ---
+
+def nearest_palette_indices(rgb, lut=None):
+    """Nearest palette index for every row of an (N, 3) uint8 RGB array"""
+    lut = lut or get_palette_lut()
+    return lut.palette_index.nearest_batch(rgb_to_space_batch(rgb, lut.key[1]))
+
+def nearest_unique_indices(rgb, lut=None):
+    """Like nearest_palette_indices, but matches every distinct color only once"""
+    lut = lut or get_palette_lut()
+    rgb = rgb.reshape(-1, 3)
+    packed = (
+        (rgb[:, 0].astype(np.uint32) << 16)
+        | (rgb[:, 1].astype(np.uint32) << 8)
+        | rgb[:, 2]
+    )
+    uniq, inverse = np.unique(packed, return_inverse=True)
+    uniq_rgb = np.stack([uniq >> 16, (uniq >> 8) & 255, uniq & 255], axis=1).astype(np.uint8)
+    return nearest_palette_indices(uniq_rgb, lut)[inverse.reshape(-1)]
+
+def quantize_image_array(img_rgba, alpha_thr, lut=None):
+    """Map an RGBA image to the palette in one vectorized pass.
+
+    Returns (indices, opaque) like error_diffusion_dither. Identical
+    colors are matched once, so cost depends on unique colors.
+    """
+    lut = lut or get_palette_lut()
+    px = np.asarray(img_rgba.convert("RGBA"), dtype=np.uint8).reshape(-1, 4)
+    opaque = px[:, 3] >= alpha_thr
+    idx = np.zeros(len(px), dtype=np.uint16)
+    if opaque.any():
+        idx[opaque] = nearest_unique_indices(px[opaque, :3], lut)
+    return array('H', idx.tobytes()), bytearray(opaque.astype(np.uint8).tobytes())
+
+# --- Error diffusion dithering ---
+# Kernels as (dx, dy, weight) taps relative to the current pixel; dx is
+# mirrored on right-to-left rows when scanning serpentine.
+DIFFUSION_KERNELS = {
+    "floyd-steinberg": (
+        (1, 0, 7/16), (-1, 1, 3/16), (0, 1, 5/16), (1, 1, 1/16),
+    ),
+    "atkinson": (
+        (1, 0, 1/8), (2, 0, 1/8), (-1, 1, 1/8), (0, 1, 1/8), (1, 1, 1/8), (0, 2, 1/8),
+    ),
+    "sierra-lite": (
+        (1, 0, 2/4), (-1, 1, 1/4), (0, 1, 1/4),
+    ),
+    "stucki": (
+        (1, 0, 8/42), (2, 0, 4/42),
+        (-2, 1, 2/42), (-1, 1, 4/42), (0, 1, 8/42), (1, 1, 4/42), (2, 1, 2/42),
+        (-2, 2, 1/42), (-1, 2, 2/42), (0, 2, 4/42), (1, 2, 2/42), (2, 2, 1/42),
+    ),
+}
+
+def error_diffusion_dither(img_rgba, alpha_thr, kernel="floyd-steinberg", serpentine=False, lut=None,
+                           progress=None):
+    """Error-diffusion dithering onto the current palette.
+
+    Keeps only (kernel height) rolling rows of float error, so memory is
+    proportional to the image width. Returns (indices, opaque): palette
+    indices as array('H') and a bytearray of 0/1 flags, both row-major.
+    `progress(fraction)` is called every few rows when given.
+    """
+    lut = lut or get_palette_lut()
+    lut.prefill()
+    taps = DIFFUSION_KERNELS[kernel]
+    w, h = img_rgba.size
+    pad = max(abs(dx) for dx, _, _ in taps)
+    nrows = max(dy for _, dy, _ in taps) + 1
+    stride = (w + 2 * pad) * 3
+    rows = [[0.0] * stride for _ in range(nrows)]
+    zero = [0.0] * stride
+    pal_rgb = lut.rgb
+    lookup = lut.index
+    src = img_rgba.convert("RGBA").tobytes()
+    indices = array('H', bytes(2 * w * h))
+    opaque = bytearray(w * h)
+    # per scan direction: (row offset, error offset delta, weight)
+    ltr = [(dy, dx * 3, wt) for dx, dy, wt in taps]
+    rtl = [(dy, -dx * 3, wt) for dx, dy, wt in taps]
+    for y in range(h):
+        if progress is not None and not y & 15:
+            progress(y / h)
+        reverse = serpentine and (y & 1)
+        xs = range(w - 1, -1, -1) if reverse else range(w)
+        spread = [(rows[dy], off, wt) for dy, off, wt in (rtl if reverse else ltr)]
+        cur = rows[0]
+        base = y * w
+        for x in xs:
+            i = base + x
+            si = i * 4
+            if src[si + 3] < alpha_thr:
+                continue
+            opaque[i] = 1
+            o = (x + pad) * 3
+            nr = round(src[si] + cur[o])
+            ng = round(src[si + 1] + cur[o + 1])
+            nb = round(src[si + 2] + cur[o + 2])
+            nr = 0 if nr < 0 else (255 if nr > 255 else nr)
+            ng = 0 if ng < 0 else (255 if ng > 255 else ng)
+            nb = 0 if nb < 0 else (255 if nb > 255 else nb)
+            pi = lookup(nr, ng, nb)
+            indices[i] = pi
+            pr, pg, pb = pal_rgb[pi]
+            dr = nr - pr
+            dg = ng - pg
+            db = nb - pb
+            for row, off, wt in spread:
+                j = o + off
+                row[j] += dr * wt
+                row[j + 1] += dg * wt
+                row[j + 2] += db * wt
+        # rotate: the finished row is cleared and reused as the farthest one
+        done = rows.pop(0)
+        done[:] = zero
+        rows.append(done)
+    return indices, opaque
+
+# --- Ordered dithering ---
+# Threshold maps hold one value per cell in (-0.5, 0.5); the whole image is
+# offset by (threshold * palette spread) and then mapped to the palette, so
+# unlike error diffusion every pixel is independent.
+
+def _bayer_matrix(n):
+    """Recursive Bayer index matrix of size n x n (n a power of two)"""
+    if n == 1:
+        return [[0]]
+    half = _bayer_matrix(n // 2)
+    m = [[0] * n for _ in range(n)]
+    for y in range(n // 2):
+        for x in range(n // 2):
+            v = 4 * half[y][x]
+            m[y][x] = v
+            m[y][x + n // 2] = v + 2
+            m[y + n // 2][x] = v + 3
+            m[y + n // 2][x + n // 2] = v + 1
+    return m
+
+def _blue_noise_matrix(n=32, sigma=1.5, seed=1):
+    """Tileable blue-noise rank matrix (void-and-cluster, Ulichney 1993)"""
+    size = n * n
+    # toroidal gaussian energy of a point at offset (dx, dy)
+    kern = [0.0] * size
+    for dy in range(n):
+        for dx in range(n):
+            ex = min(dx, n - dx)
+            ey = min(dy, n - dy)
+            kern[dy * n + dx] = math.exp(-(ex * ex + ey * ey) / (2 * sigma * sigma))
+    energy = [0.0] * size
+    ones = [False] * size
+
+    def toggle(p, on):
+        ones[p] = on
+        sign = 1.0 if on else -1.0
+        px, py = p % n, p // n
+        for q in range(size):
+            energy[q] += sign * kern[((q // n - py) % n) * n + (q % n - px) % n]
+
+    def tightest_cluster():
+        return max((i for i in range(size) if ones[i]), key=energy.__getitem__)
+
+    def largest_void():
+        return min((i for i in range(size) if not ones[i]), key=energy.__getitem__)
+
+    rng = random.Random(seed)
+    for p in rng.sample(range(size), size // 10):
+        toggle(p, True)
+    # relax the initial pattern until the tightest cluster is the largest void
+    while True:
+        c = tightest_cluster()
+        toggle(c, False)
+        v = largest_void()
+        if v == c:
+            toggle(c, True)
+            break
+        toggle(v, True)
+    initial = list(ones)
+    count = sum(initial)
+    ranks = [0] * size
+    # phase 1: rank the initial points by removing tightest clusters
+    for rank in range(count - 1, -1, -1):
+        c = tightest_cluster()
+        toggle(c, False)
+        ranks[c] = rank
+    # phase 2/3: restore them and fill the largest voids
+    for p in range(size):
+        if initial[p]:
+            toggle(p, True)
+    for rank in range(count, size):
+        v = largest_void()
+        toggle(v, True)
+        ranks[v] = rank
+    return [ranks[y * n:(y + 1) * n] for y in range(n)]
+
+ORDERED_DITHER_MODES = {
+    "bayer2": lambda: _bayer_matrix(2),
+    "bayer4": lambda: _bayer_matrix(4),
+    "bayer8": lambda: _bayer_matrix(8),
+    "blue-noise": _blue_noise_matrix,
+}
+
+_THRESHOLD_MAPS = {}
+
+def ordered_threshold_map(mode):
+    """Normalized threshold map for an ordered mode: list of rows in (-0.5, 0.5)"""
+    tmap = _THRESHOLD_MAPS.get(mode)
+    if tmap is None:
+        ranks = ORDERED_DITHER_MODES[mode]()
+        levels = len(ranks) * len(ranks[0])
+        tmap = [[(v + 0.5) / levels - 0.5 for v in row] for row in ranks]
+        _THRESHOLD_MAPS[mode] = tmap
+    return tmap
+
+def _palette_spread(pal_rgb):
+    """Mean RGB distance from each palette color to its closest neighbour"""
+    if len(pal_rgb) < 2:
+        return 0.0
+    total = 0.0
+    for i, (r, g, b) in enumerate(pal_rgb):
+        best = min(
+            (r - r2) ** 2 + (g - g2) ** 2 + (b - b2) ** 2
+            for j, (r2, g2, b2) in enumerate(pal_rgb) if j != i
+        )
+        total += best ** 0.5
+    return total / len(pal_rgb)
+
+def ordered_dither(img_rgba, alpha_thr, mode="bayer4", lut=None):
+    """Ordered dithering onto the current palette.
+
+    Returns (indices, opaque) in the same form as error_diffusion_dither.
+    With NumPy the threshold offset and palette lookup are whole-image
+    array operations.
+    """
+    lut = lut or get_palette_lut()
+    tmap = ordered_threshold_map(mode)
+    n = len(tmap)
+    spread = _palette_spread(lut.rgb)
+    w, h = img_rgba.size
+    if np is not None:
+        px = np.asarray(img_rgba.convert("RGBA"), dtype=np.uint8)
+        offset = np.tile(np.array(tmap) * spread, (h // n + 1, w // n + 1))[:h, :w]
+        rgb = np.clip(np.rint(px[..., :3] + offset[..., None]), 0, 255).astype(np.uint8)
+        opaque = px[..., 3] >= alpha_thr
+        idx = np.zeros((h, w), dtype=np.uint16)
+        if opaque.any():
+            idx[opaque] = nearest_unique_indices(rgb[opaque], lut)
+        return array('H', idx.tobytes()), bytearray(opaque.astype(np.uint8).tobytes())
+    src = img_rgba.convert("RGBA").tobytes()
+    indices = array('H', bytes(2 * w * h))
+    opaque = bytearray(w * h)
+    lookup = lut.index
+    for y in range(h):
+        trow = [t * spread for t in tmap[y % n]]
+        for x in range(w):
+            i = y * w + x
+            si = i * 4
+            if src[si + 3] < alpha_thr:
+                continue
+            opaque[i] = 1
+            t = trow[x % n]
+            r = min(255, max(0, round(src[si] + t)))
+            g = min(255, max(0, round(src[si + 1] + t)))
+            b = min(255, max(0, round(src[si + 2] + t)))
+            indices[i] = lookup(r, g, b)
+    return indices, opaque
+
+def quantize_image(img_rgba, alpha_thr, dither=False, mode="floyd-steinberg", serpentine=False, lut=None,
+                   progress=None):
+    """Quantize an RGBA image to the current palette.
+
+    Returns (IndexedImage, DrawMask); cells with alpha below `alpha_thr`
+    are left out of the mask. `progress` is passed on to error diffusion.
+    """
+    lut = lut or get_palette_lut()
+    w, h = img_rgba.size
+    if dither and mode in ORDERED_DITHER_MODES:
+        indices, opaque = ordered_dither(img_rgba, alpha_thr, mode, lut)
+    elif dither:
+        indices, opaque = error_diffusion_dither(img_rgba, alpha_thr, mode, serpentine, lut, progress)
+    elif np is not None:
+        indices, opaque = quantize_image_array(img_rgba, alpha_thr, lut)
+    else:
+        src = img_rgba.convert("RGBA").tobytes()
+        indices = array('H', bytes(2 * w * h))
+        opaque = bytearray(w * h)
+        lookup = lut.index
+        for i in range(w * h):
+            si = i * 4
+            if src[si + 3] >= alpha_thr:
+                opaque[i] = 1
+                indices[i] = lookup(src[si], src[si + 1], src[si + 2])
+    return IndexedImage((w, h), lut.palette, indices), DrawMask.from_flags(opaque, w, h)
+
+# --- Margin trimming ---
+
+def content_bbox(img_rgba, bg, alpha_thr, tol):
+    """Bounding box (left, top, right, bottom) of the non-empty cells, or None.
+
+    A cell is empty when its alpha is below `alpha_thr` or the sum of its
+    per-channel distances to `bg` is at most 3 * tol. The whole mask is
+    computed with array/channel arithmetic and reduced in one step.
+    """
+    if img_rgba.mode != "RGBA":
+        img_rgba = img_rgba.convert("RGBA")
+    if np is not None:
+        px = np.asarray(img_rgba)
+        dist = np.zeros(px.shape[:2], dtype=np.uint16)
+        for c in range(3):
+            ch = px[..., c]
+            ref = np.uint8(bg[c])
+            # |ch - ref| without leaving uint8
+            dist += np.maximum(ch, ref) - np.minimum(ch, ref)
+        content = (px[..., 3] >= alpha_thr) & (dist > 3 * tol)
+        rows = np.flatnonzero(content.any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(content.any(axis=0))
+        return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+    r, g, b, a = img_rgba.split()
+    solid = Image.new("RGB", img_rgba.size, tuple(bg[:3]))
+    dr, dg, db = ImageChops.difference(img_rgba.convert("RGB"), solid).split()
+    limit = 3 * tol
+    if hasattr(ImageMath, "lambda_eval"):
+        content = ImageMath.lambda_eval(
+            lambda e: e["convert"](((e["dr"] + e["dg"] + e["db"]) > limit) & (e["a"] >= alpha_thr), "L"),
+            dr=dr, dg=dg, db=db, a=a,
+        )
+    else:
+        content = ImageMath.eval(
+            "convert(((dr + dg + db) > limit) & (a >= alpha_thr), 'L')",
+            dr=dr, dg=dg, db=db, a=a, limit=limit, alpha_thr=alpha_thr,
+        )
+    return content.getbbox()
+
+# --- K-means palette builder ---
+_KMEANS_MAX_POINTS = 1 << 15  # above this many unique colors, bin by 5 bits/channel
+
+def _weighted_colors(img):
+    """Collapse an image into (rgb points, weights) of distinct colors.
+
+    Images with very many distinct colors are binned into a 32^3 histogram
+    (mean color per bin with NumPy, bin center without it).
+    """
+    img = img.convert("RGB")
+    w, h = img.size
+    if np is not None:
+        px = np.asarray(img, dtype=np.uint8).reshape(-1, 3)
+        packed = (px[:, 0].astype(np.uint32) << 16) | (px[:, 1].astype(np.uint32) << 8) | px[:, 2]
+        uniq, counts = np.unique(packed, return_counts=True)
+        if len(uniq) <= _KMEANS_MAX_POINTS:
+            rgb = np.stack([uniq >> 16, (uniq >> 8) & 255, uniq & 255], axis=1).astype(np.float64)
+            return rgb, counts.astype(np.float64)
+        bins = ((px[:, 0] >> 3).astype(np.intp) << 10) | ((px[:, 1] >> 3).astype(np.intp) << 5) | (px[:, 2] >> 3)
+        weights = np.bincount(bins, minlength=1 << 15).astype(np.float64)
+        sums = np.stack([np.bincount(bins, px[:, c], minlength=1 << 15) for c in range(3)], axis=1)
+        used = weights > 0
+        return sums[used] / weights[used, None], weights[used]
+    colors = img.getcolors(w * h)
+    if len(colors) > _KMEANS_MAX_POINTS // 8:
+        # 4 bits per channel keeps the pure-Python loop short
+        colors = img.point(lambda v: (v & 0xF0) | 0x08).getcolors(w * h)
+    return [c for _, c in colors], [float(n) for n, _ in colors]
+
+def _kmeans_pp_np(pts, weights, k, rng):
+    """Weighted k-means++ seeding"""
+    first = rng.choice(len(pts), p=weights / weights.sum())
+    centers = [pts[first]]
+    d2 = ((pts - pts[first]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        prob = weights * d2
+        total = prob.sum()
+        if total <= 0:
+            break
+        i = rng.choice(len(pts), p=prob / total)
+        centers.append(pts[i])
+        d2 = np.minimum(d2, ((pts - pts[i]) ** 2).sum(axis=1))
+    return np.array(centers)
+
+def _assign_np(pts, centers):
+    c_sq = (centers * centers).sum(axis=1)
+    return (c_sq[None, :] - 2.0 * (pts @ centers.T)).argmin(axis=1)
+
+def _kmeans_np(pts, weights, k, seed, iters, batch_size):
+    rng = np.random.default_rng(seed)
+    centers = _kmeans_pp_np(pts, weights, k, rng)
+    k = len(centers)
+    seen = np.zeros(k)
+    prob = weights / weights.sum()
+    # mini-batch: per-center running means with a 1/count learning rate
+    for _ in range(iters):
+        sample = pts[rng.choice(len(pts), size=batch_size, p=prob)]
+        labels = _assign_np(sample, centers)
+        hits = np.bincount(labels, minlength=k).astype(np.float64)
+        sums = np.stack([np.bincount(labels, sample[:, c], minlength=k) for c in range(3)], axis=1)
+        seen += hits
+        moved = hits > 0
+        centers[moved] += (sums[moved] - hits[moved, None] * centers[moved]) / seen[moved, None]
+    # two full weighted Lloyd passes over the (collapsed) points to settle
+    for _ in range(2):
+        labels = _assign_np(pts, centers)
+        mass = np.bincount(labels, weights, minlength=k)
+        sums = np.stack([np.bincount(labels, weights * pts[:, c], minlength=k) for c in range(3)], axis=1)
+        filled = mass > 0
+        centers[filled] = sums[filled] / mass[filled, None]
+    return [tuple(c) for c in centers]
+
+def _kmeans_py(pts, weights, k, seed, iters):
+    rng = random.Random(seed)
+    def d2(p, c):
+        return (p[0]-c[0])**2 + (p[1]-c[1])**2 + (p[2]-c[2])**2
+    centers = [pts[rng.choices(range(len(pts)), weights)[0]]]
+    dist = [d2(p, centers[0]) for p in pts]
+    while len(centers) < k:
+        prob = [w * d for w, d in zip(weights, dist)]
+        if sum(prob) <= 0:
+            break
+        c = pts[rng.choices(range(len(pts)), prob)[0]]
+        centers.append(c)
+        dist = [min(d, d2(p, c)) for p, d in zip(pts, dist)]
+    for _ in range(iters):
+        sums = [[0.0, 0.0, 0.0, 0.0] for _ in centers]
+        for p, w in zip(pts, weights):
+            bi = min(range(len(centers)), key=lambda i: d2(p, centers[i]))
+            acc = sums[bi]
+            acc[0] += w * p[0]; acc[1] += w * p[1]; acc[2] += w * p[2]; acc[3] += w
+        new_centers = [
+            (a[0] / a[3], a[1] / a[3], a[2] / a[3]) if a[3] else c
+            for a, c in zip(sums, centers)
+        ]
+        if new_centers == centers:
+            break
+        centers = new_centers
+    return centers
+
+def kmeans_palette(img, k, algorithm=None, seed=0, iters=40, batch_size=1024):
+    """Pick up to k representative colors of an image with k-means.
+
+    Identical colors are collapsed into weighted points, seeded with
+    k-means++ and clustered in the color space of `algorithm` (defaults to
+    COLOR_ALGORITHM), so the centers match the active distance metric. With
+    NumPy the updates are vectorized mini-batches. Results are reproducible
+    for a given `seed`. Returns distinct (r, g, b) tuples.
+    """
+    algorithm = algorithm or COLOR_ALGORITHM
+    rgb, weights = _weighted_colors(img)
+    if len(weights) == 0:
+        return []
+    k = max(1, min(k, len(weights)))
+    if np is not None:
+        pts = rgb_to_space_batch(np.rint(rgb).astype(np.uint8), algorithm)
+        centers = _kmeans_np(pts, np.asarray(weights), k, seed, iters, batch_size)
+    else:
+        pts = rgb_to_space_batch(rgb, algorithm)
+        centers = _kmeans_py(pts, weights, k, seed, min(iters, 10))
+    seen = set()
+    uniq = []
+    for c in centers:
+        rgb_c = space_to_rgb(c, algorithm)
+        if rgb_c not in seen:
+            seen.add(rgb_c)
+            uniq.append(rgb_c)
+    return uniq
+
+# --- Palette swatch detection ---
+
+@dataclass
+class Swatch:
+    rgb: tuple
+    center: tuple  # (x, y) in capture coordinates
+    box: tuple  # (left, top, right, bottom), right/bottom exclusive
+
+def detect_swatches(img, tol=8, min_side=6, min_fill=0.85, max_share=0.25):
+    """Find uniform rectangular color tiles in a capture of the palette area.
+
+    Flood-fills regions whose pixels stay within `tol` (per channel) of the
+    region's first pixel and keeps the ones that look like swatches: at
+    least `min_side` px each way, filling at least `min_fill` of their
+    bounding box and not larger than `max_share` of the capture (that is
+    the background). A swatch's color is the most frequent pixel value of
+    its region, so blended edge pixels do not shift it. Returns one Swatch
+    per color, in reading order.
+    """
+    img = img.convert("RGB")
+    w, h = img.size
+    data = img.tobytes()
+    seen = bytearray(w * h)
+    best = {}
+    for start in range(w * h):
+        if seen[start]:
+            continue
+        seen[start] = 1
+        si = start * 3
+        r0, g0, b0 = data[si], data[si + 1], data[si + 2]
+        stack = [start]
+        area = 0
+        counts = {}
+        minx = maxx = start % w
+        miny = maxy = start // w
+        while stack:
+            i = stack.pop()
+            x, y = i % w, i // w
+            area += 1
+            sj = i * 3
+            key = data[sj:sj + 3]
+            counts[key] = counts.get(key, 0) + 1
+            if x < minx: minx = x
+            elif x > maxx: maxx = x
+            if y < miny: miny = y
+            elif y > maxy: maxy = y
+            for j, ok in ((i - 1, x > 0), (i + 1, x < w - 1), (i - w, y > 0), (i + w, y < h - 1)):
+                if ok and not seen[j]:
+                    sj = j * 3
+                    if (abs(data[sj] - r0) <= tol and abs(data[sj + 1] - g0) <= tol
+                            and abs(data[sj + 2] - b0) <= tol):
+                        seen[j] = 1
+                        stack.append(j)
+        bw = maxx - minx + 1
+        bh = maxy - miny + 1
+        if bw < min_side or bh < min_side or area > max_share * w * h or area < min_fill * bw * bh:
+            continue
+        rgb = tuple(max(counts, key=counts.get))
+        sw = Swatch(rgb, (minx + bw // 2, miny + bh // 2), (minx, miny, maxx + 1, maxy + 1))
+        prev = best.get(rgb)
+        if prev is None or area > (prev.box[2] - prev.box[0]) * (prev.box[3] - prev.box[1]):
+            best[rgb] = sw
+    return sorted(best.values(), key=lambda sw: (sw.box[1], sw.box[0]))
+
+SWATCH_MATCH_TOL = 24  # max per-channel difference for a captured color to stand for a palette color
+
+class SwatchIndex:
+    """Color -> screen position lookup built from one capture of the palette area.
+
+    Colors are matched to the nearest detected swatch within a tolerance,
+    so palettes whose hexes differ slightly from the rendered (or
+    anti-aliased) tiles still hit. Every answer is memoized in `positions`;
+    pass them as `known` to carry them over to a new capture.
+    """
+
+    def __init__(self, capture, origin=(0, 0), known=None):
+        self.origin = tuple(origin)
+        self.capture = capture.convert("RGB")
+        ox, oy = self.origin
+        swatches = detect_swatches(self.capture)
+        self.swatch_rgb = [sw.rgb for sw in swatches]
+        self.swatch_pos = [(ox + sw.center[0], oy + sw.center[1]) for sw in swatches]
+        self.positions = dict(known or {})
+        self._swatch_arr = None
+        self._pixels = None
+
+    def _nearest_swatch(self, rgb):
+        """(index, max channel difference) of the detected swatch closest to rgb"""
+        if not self.swatch_rgb:
+            return None, None
+        if np is not None:
+            if self._swatch_arr is None:
+                self._swatch_arr = np.asarray(self.swatch_rgb, dtype=np.int32)
+            diff = np.abs(self._swatch_arr - np.asarray(rgb, dtype=np.int32))
+            i = int((diff * diff).sum(axis=1).argmin())
+            return i, int(diff[i].max())
+        r, g, b = rgb
+        i = min(range(len(self.swatch_rgb)), key=lambda k: (self.swatch_rgb[k][0] - r) ** 2
+                + (self.swatch_rgb[k][1] - g) ** 2 + (self.swatch_rgb[k][2] - b) ** 2)
+        sr, sg, sb = self.swatch_rgb[i]
+        return i, max(abs(sr - r), abs(sg - g), abs(sb - b))
+
+    def lookup(self, hx, tol=SWATCH_MATCH_TOL, palette=None):
+        """Position of a remembered color or of the nearest swatch within `tol`, or None.
+
+        The swatch must also be closer to `hx` than to any other color of
+        `palette` (default: the current one), so a color whose own tile was
+        not detected does not borrow a neighbour's.
+        """
+        hx = hx.upper()
+        pos = self.positions.get(hx)
+        if pos is None:
+            i, d = self._nearest_swatch(hex_to_rgb(hx))
+            if i is None or d > tol:
+                return None
+            r, g, b = self.swatch_rgb[i]
+            candidates = {c.upper() for c in (palette if palette is not None else CURRENT_PALETTE)} | {hx}
+            owner = min(candidates, key=lambda c: sum((u - v) ** 2 for u, v in zip(hex_to_rgb(c), (r, g, b))))
+            if owner != hx:
+                return None
+            pos = self.positions[hx] = self.swatch_pos[i]
+        return pos
+
+    def search(self, hx, tol=None):
+        """Screen position of the capture pixel closest to a color.
+
+        With `tol`, returns None when even that pixel differs by more than
+        `tol` in some channel; otherwise the hit is memoized.
+        """
+        hx = hx.upper()
+        tr, tg, tb = hex_to_rgb(hx)
+        w, h = self.capture.size
+        if np is not None:
+            if self._pixels is None:
+                self._pixels = np.asarray(self.capture, dtype=np.int32)
+            d = ((self._pixels - np.array([tr, tg, tb], dtype=np.int32)) ** 2).sum(axis=2)
+            yy, xx = divmod(int(d.argmin()), w)
+            r, g, b = (int(v) for v in self._pixels[yy, xx])
+        else:
+            pix = self.capture.load()
+            best_d = None
+            step = max(1, min(w, h) // 60)  # coarse scan
+            for y in range(0, h, step):
+                for x in range(0, w, step):
+                    r, g, b = pix[x, y]
+                    d = (r - tr)**2 + (g - tg)**2 + (b - tb)**2
+                    if best_d is None or d < best_d:
+                        best_d, xx, yy = d, x, y
+            r, g, b = pix[xx, yy]
+        if tol is not None and max(abs(r - tr), abs(g - tg), abs(b - tb)) > tol:
+            return None
+        pos = (self.origin[0] + xx, self.origin[1] + yy)
+        self.positions[hx] = pos
+        return pos
+
+# --- Stroke planning ---
+# Orders the cells of one color so the cursor travels less between clicks.
+STROKE_ORDERS = ("raster", "serpentine", "nearest", "hilbert")
+_TWO_OPT_MAX_POINTS = 50000  # 2-opt is skipped above this (quadratic-ish even windowed)
+
+def path_length(points):
+    """Total Euclidean length of a polyline given as (x, y) points"""
+    total = 0.0
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        total += math.hypot(x1 - x0, y1 - y0)
+    return total
+
+def _hilbert_index(n, x, y):
+    """Distance of (x, y) along the Hilbert curve filling an n x n grid (n a power of two)"""
+    d = 0
+    s = n // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s //= 2
+    return d
+
+def _nearest_neighbor_order(pts):
+    """Greedy nearest-neighbour tour starting at the first point (bucket grid search)"""
+    n = len(pts)
+    if n <= 2:
+        return list(range(n))
+    xs = [p[0] for p in pts]
+    ys = [p[1] for p in pts]
+    min_x, min_y = min(xs), min(ys)
+    area = max(1.0, (max(xs) - min_x + 1) * (max(ys) - min_y + 1))
+    cell = max(1.0, math.sqrt(area / n))
+    buckets = defaultdict(list)
+    for i, (x, y) in enumerate(pts):
+        buckets[(int((x - min_x) / cell), int((y - min_y) / cell))].append(i)
+    def take(i):
+        key = (int((pts[i][0] - min_x) / cell), int((pts[i][1] - min_y) / cell))
+        b = buckets[key]
+        b.remove(i)
+        if not b:
+            del buckets[key]
+    order = [0]
+    take(0)
+    cur = 0
+    for _ in range(n - 1):
+        cx, cy = pts[cur]
+        bx, by = int((cx - min_x) / cell), int((cy - min_y) / cell)
+        best = -1
+        best_d = float("inf")
+        r = 0
+        while True:
+            if (2 * r + 1) ** 2 >= len(buckets):
+                # the ring would visit more cells than are left: scan what remains
+                for b in buckets.values():
+                    for i in b:
+                        d = (pts[i][0] - cx) ** 2 + (pts[i][1] - cy) ** 2
+                        if d < best_d:
+                            best_d, best = d, i
+                break
+            for gx in range(bx - r, bx + r + 1):
+                for gy in (range(by - r, by + r + 1) if gx in (bx - r, bx + r) else (by - r, by + r)):
+                    for i in buckets.get((gx, gy), ()):
+                        d = (pts[i][0] - cx) ** 2 + (pts[i][1] - cy) ** 2
+                        if d < best_d:
+                            best_d, best = d, i
+            # anything beyond ring r is at least r cells away
+            if best >= 0 and (r * cell) ** 2 >= best_d:
+                break
+            r += 1
+        order.append(best)
+        take(best)
+        cur = best
+    return order
+
+def _two_opt(order, pts, window=24, passes=2):
+    """Windowed 2-opt on an open path: reverse segments that shorten it"""
+    n = len(order)
+    def dist(i, j):
+        a, b = pts[order[i]], pts[order[j]]
+        return math.hypot(a[0] - b[0], a[1] - b[1])
+    for _ in range(passes):
+        improved = False
+        for i in range(n - 2):
+            for j in range(i + 2, min(n, i + window)):
+                if j == n - 1:
+                    delta = dist(i, j) - dist(i, i + 1)
+                else:
+                    delta = dist(i, j) + dist(i + 1, j + 1) - dist(i, i + 1) - dist(j, j + 1)
+                if delta < -1e-9:
+                    order[i + 1:j + 1] = order[i + 1:j + 1][::-1]
+                    improved = True
+        if not improved:
+            break
+    return order
+
+def _screen_points(pixels, point_of):
+    pts = []
+    for x, y in zip(pixels.xs, pixels.ys):
+        p = point_of(x, y) if point_of is not None else None
+        pts.append(p if p is not None else (x, y))
+    return pts
+
+def plan_strokes(pixels, strategy="raster", point_of=None):
+    """Order a PixelSet for drawing.
+
+    `point_of(x, y)` maps a cell to its screen position (None -> grid
+    coordinates are used). Returns (ordered PixelSet, travel before, travel
+    after), travel being the cursor path length in screen units.
+    """
+    cells = list(zip(pixels.xs, pixels.ys))
+    pts = _screen_points(pixels, point_of)
+    before = path_length(pts)
+    n = len(cells)
+    if strategy == "serpentine":
+        order = sorted(range(n), key=lambda i: (cells[i][1], cells[i][0] if cells[i][1] % 2 == 0 else -cells[i][0]))
+    elif strategy == "hilbert":
+        side = 1
+        while side < max([c for xy in cells for c in xy] + [1]) + 1:
+            side *= 2
+        order = sorted(range(n), key=lambda i: _hilbert_index(side, cells[i][0], cells[i][1]))
+    elif strategy == "nearest":
+        order = _nearest_neighbor_order(pts)
+        if n <= _TWO_OPT_MAX_POINTS:
+            order = _two_opt(order, pts)
+    else:
+        return pixels, before, before
+    return pixels.take(order), before, path_length([pts[i] for i in order])
+
+# --- Sequence planning (color switches as a cost) ---
+@dataclass
+class DrawCostModel:
+    """Timing model of one drawing session, in seconds (distances in screen px)"""
+    click_sleep: float = 0.05  # pause after every canvas click (click_sleep_var)
+    switch_sleep: float = 0.2  # pause after a palette click (select_palette_color)
+    input_pause: float = 0.2  # implicit pause per click (InputDriver.implicit_pause)
+    move_speed: float = 5000.0  # cursor travel speed; <= 0 means moves are free
+    start_delay: float = 0.0
+
+    def click_cost(self):
+        return self.input_pause + self.click_sleep
+
+    def switch_cost(self):
+        return self.input_pause + self.switch_sleep
+
+    def travel_cost(self, dist):
+        return dist / self.move_speed if self.move_speed > 0 else 0.0
+
+# predict_sequence_duration with this model returns the cursor path in px
+_TRAVEL_ONLY = DrawCostModel(click_sleep=0.0, switch_sleep=0.0, input_pause=0.0, move_speed=1.0)
+
+REGION_SPLITS = (1, 2, 3, 4)  # n -> canvas cut into n x n tiles
+
+def _split_regions(pixels, n, width, height):
+    """Split a PixelSet into n x n tiles: {(row, col): indices in their original order}"""
+    if n <= 1:
+        return {(0, 0): range(len(pixels))}
+    tw = -(-width // n)
+    th = -(-height // n)
+    tiles = defaultdict(list)
+    for i, (x, y) in enumerate(zip(pixels.xs, pixels.ys)):
+        tiles[(y // th, x // tw)].append(i)
+    return tiles
+
+def _dist(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+def _plan_with_regions(planned, regions, swatch_of, model, size, start):
+    width, height = size
+    # (hx, ordered cells, their screen points, travel inside) per tile; a tile
+    # walks its cells in the order of the whole color's tour
+    by_tile = defaultdict(list)
+    for hx, (ordered, points) in planned.items():
+        for key, idx in _split_regions(ordered, regions, width, height).items():
+            pts = [points[i] for i in idx]
+            part = ordered if len(pts) == len(ordered) else ordered.take(idx)
+            by_tile[key].append((hx, part, pts, path_length(pts)))
+
+    sequence = []
+    total = model.start_delay
+    travel = 0.0
+    switches = 0
+    cur_pos = start
+    cur_color = None
+    # tiles row by row, alternating direction
+    for key in sorted(by_tile, key=lambda k: (k[0], k[1] if k[0] % 2 == 0 else -k[1])):
+        pending = by_tile[key]
+        while pending:
+            # keep the active color while this tile still has cells of it
+            same = [i for i, chunk in enumerate(pending) if chunk[0] == cur_color]
+            best = None
+            for ci in same or range(len(pending)):
+                hx, _, pts, _ = pending[ci]
+                lead, pos = 0.0, cur_pos
+                if hx != cur_color:
+                    lead = model.switch_cost()
+                    sw = swatch_of(hx)
+                    if sw is not None:
+                        if cur_pos is not None:
+                            lead += model.travel_cost(_dist(cur_pos, sw))
+                        pos = sw
+                # cells may be walked from either end
+                for rev in (False, True):
+                    move = _dist(pos, pts[-1] if rev else pts[0]) if pos is not None else 0.0
+                    cost = lead + model.travel_cost(move)
+                    if best is None or cost < best[0]:
+                        best = (cost, ci, rev, pos, move)
+            cost, ci, rev, pos, move = best
+            hx, ordered, pts, inner = pending.pop(ci)
+            if rev:
+                ordered = ordered.take(range(len(ordered) - 1, -1, -1))
+                pts = pts[::-1]
+            if hx != cur_color:
+                sequence.append(("COLOR", hx))
+                switches += 1
+                if pos is not cur_pos:
+                    travel += _dist(cur_pos, pos) if cur_pos is not None else 0.0
+                cur_color = hx
+                sequence.append(ordered)
+            else:
+                # same color carried over from the previous tile: extend its step
+                last = sequence[-1]
+                sequence[-1] = PixelSet(last.palette, last.xs + ordered.xs,
+                                        last.ys + ordered.ys, last.colors + ordered.colors)
+            travel += move + inner
+            total += cost + model.travel_cost(inner) + len(ordered) * model.click_cost()
+            cur_pos = pts[-1]
+    return sequence, total, travel, switches
+
+def plan_color_sequence(groups, size, strategy="raster", point_of=None, swatch_of=None,
+                        model=None, regions=1, start=None):
+    """Plan the ("COLOR", hx) / PixelSet sequence for drawing every group.
+
+    Colors are ordered greedily by the time to reach the next one: palette
+    click + travel to its swatch + travel into its first cell (cells may be
+    walked in reverse). With `regions` > 1 the canvas is cut into tiles drawn
+    one after another; `regions=None` tries every REGION_SPLITS value and
+    keeps the fastest plan. Each color's strokes are planned once and shared
+    by all splits. `swatch_of(hx)` gives a swatch position or None.
+    Returns (sequence, predicted seconds, travel px, palette switches,
+    travel px of the unplanned sequence: colors and cells as given).
+    """
+    model = model or DrawCostModel()
+    swatch_of = swatch_of or (lambda hx: None)
+    groups = {hx: px for hx, px in groups.items() if len(px)}
+    if not groups:
+        return [], model.start_delay, 0.0, 0, 0.0
+    unplanned = [step for hx, pixels in groups.items() for step in (("COLOR", hx), pixels)]
+    before = predict_sequence_duration(unplanned, point_of, swatch_of, _TRAVEL_ONLY, start)
+    planned = {}
+    for hx, pixels in groups.items():
+        ordered, _, _ = plan_strokes(pixels, strategy, point_of)
+        planned[hx] = (ordered, _screen_points(ordered, point_of))
+    candidates = REGION_SPLITS if regions is None else (regions,)
+    best = None
+    for n in candidates:
+        plan = _plan_with_regions(planned, n, swatch_of, model, size, start)
+        if best is None or plan[1] < best[1]:
+            best = plan
+    return best + (before,)
+
+def predict_sequence_duration(sequence, point_of=None, swatch_of=None, model=None, start=None):
+    """Predicted seconds for a ("COLOR", hx) / PixelSet drawing sequence"""
+    model = model or DrawCostModel()
+    total = model.start_delay
+    pos = start
+    for item in sequence:
+        if isinstance(item, tuple) and item[0] == "COLOR":
+            total += model.switch_cost()
+            sw = swatch_of(item[1]) if swatch_of is not None else None
+            if sw is not None:
+                if pos is not None:
+                    total += model.travel_cost(_dist(pos, sw))
+                pos = sw
+            continue
+        for x, y in zip(item.xs, item.ys):
+            p = point_of(x, y) if point_of is not None else None
+            p = p if p is not None else (x, y)
+            if pos is not None:
+                total += model.travel_cost(_dist(pos, p))
+            pos = p
+            total += model.click_cost()
+    return total
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+# --- Input drivers ---
+class InputDriver:
+    """Clicks cells on screen; the draw workers only talk to this interface"""
+    name = "base"
+
+    def click_at(self, x, y):
+        raise NotImplementedError
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+
+    def implicit_pause(self):
+        """Seconds the backend sleeps on its own per click_at"""
+        return 0.0
+
+    def available(self):
+        """False when the backend cannot run here (e.g. pyautogui missing)"""
+        return True
+
+class PyAutoGuiDriver(InputDriver):
+    """moveTo + click, each paying pyautogui.PAUSE"""
+    name = "pyautogui"
+
+    def click_at(self, x, y):
+        pyautogui = get_pyautogui()
+        pyautogui.moveTo(x, y)
+        pyautogui.click()
+
+    def implicit_pause(self):
+        return 2 * get_pyautogui().PAUSE
+
+    def available(self):
+        return get_pyautogui() is not None
+
+class TurboDriver(InputDriver):
+    """One combined move+click without PAUSE, paced against a deadline.
+
+    The failsafe check still runs on every call. wait() counts from the
+    previous deadline, so the time spent clicking is part of the interval
+    instead of being added on top of it.
+    """
+    name = "turbo"
+    _SPIN = 0.002  # last stretch is busy-waited, sleep() overshoots by ~1 ms
+
+    def __init__(self):
+        self._deadline = None
+
+    def available(self):
+        return get_pyautogui() is not None
+
+    def click_at(self, x, y):
+        get_pyautogui().click(x, y, _pause=False)
+
+    def wait(self, seconds):
+        now = time.perf_counter()
+        if self._deadline is None or now - self._deadline > seconds:
+            # first wait or fell behind (e.g. a palette switch): restart the grid
+            self._deadline = now
+        self._deadline += seconds
+        remaining = self._deadline - time.perf_counter()
+        if remaining > self._SPIN:
+            time.sleep(remaining - self._SPIN)
+        while time.perf_counter() < self._deadline:
+            pass
+
+class RecordingDriver(InputDriver):
+    """Stand-in for headless runs: records clicks against a virtual clock"""
+    name = "recording"
+
+    def __init__(self):
+        self.events = []  # (x, y, virtual time)
+        self.clock = 0.0
+
+    def click_at(self, x, y):
+        self.events.append((x, y, self.clock))
+
+    def wait(self, seconds):
+        self.clock += seconds
+
+INPUT_DRIVERS = {
+    PyAutoGuiDriver.name: PyAutoGuiDriver,
+    TurboDriver.name: TurboDriver,
+    RecordingDriver.name: RecordingDriver,
+}
+
+# --- Cell -> screen coordinates ---
+def _solve_linear(a, b):
+    """Solve a x = b (small dense system, Gaussian elimination with pivoting)"""
+    n = len(b)
+    m = [list(map(float, row)) + [float(v)] for row, v in zip(a, b)]
+    for col in range(n):
+        piv = max(range(col, n), key=lambda r: abs(m[r][col]))
+        if abs(m[piv][col]) < 1e-12:
+            raise ValueError("singular system")
+        m[col], m[piv] = m[piv], m[col]
+        for r in range(n):
+            if r != col:
+                f = m[r][col] / m[col][col]
+                if f:
+                    for c in range(col, n + 1):
+                        m[r][c] -= f * m[col][c]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+def homography_from_points(src, dst):
+    """3x3 projective transform (row-major, h[8] == 1) mapping 4 src points onto dst"""
+    a = []
+    b = []
+    for (x, y), (u, v) in zip(src, dst):
+        a.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        b.append(u)
+        a.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        b.append(v)
+    return _solve_linear(a, b) + [1.0]
+
+def _is_convex_quad(corners):
+    """True when the points, taken in order around the quad, turn the same way at every corner"""
+    turns = []
+    for i in range(4):
+        (ax, ay), (bx, by), (cx, cy) = corners[i], corners[(i + 1) % 4], corners[(i + 2) % 4]
+        turns.append((bx - ax) * (cy - by) - (by - ay) * (cx - bx))
+    return all(t > 0 for t in turns) or all(t < 0 for t in turns)
+
+def _grid_homography(width, height, tl, tr, bl, br):
+    """Homography for the 4-point calibration, or None when it would fold the grid.
+
+    The quad must be convex, and the projective denominator must stay
+    positive over the grid. It is linear in (x, y), so checking the four
+    corner cells is enough.
+    """
+    if not _is_convex_quad([tl, tr, br, bl]):
+        return None
+    last_x, last_y = width - 1, height - 1
+    try:
+        h = homography_from_points([(0, 0), (last_x, 0), (0, last_y), (last_x, last_y)], [tl, tr, bl, br])
+    except ValueError:
+        return None
+    if any(h[6] * x + h[7] * y + h[8] <= 1e-9 for x, y in ((0, 0), (last_x, 0), (0, last_y), (last_x, last_y))):
+        return None
+    return h
+
+class CellGrid:
+    """Screen position of every cell center, computed once per calibration.
+
+    Modes: "homography" (TL, TR, BL, BR: corrects perspective/zoom skew),
+    "affine" (TL, TR, BL) and "axis" (TL, BR). A BR that does not form a
+    convex quad with the other three is ignored (`note` says so) and the
+    grid falls back to affine. Positions are kept in two int arrays in
+    row-major order.
+    """
+
+    def __init__(self, width, height, tl, tr=None, bl=None, br=None):
+        self.width = width
+        self.height = height
+        self.key = (width, height, tl, tr, bl, br)
+        self.note = ""
+        h = None
+        if tr and bl and br and width > 1 and height > 1:
+            h = _grid_homography(width, height, tl, tr, bl, br)
+            if h is None:
+                self.note = "BR не образует выпуклый четырёхугольник, точка не используется"
+        if h is not None:
+            self.mode = "homography"
+        elif tr and bl:
+            self.mode = "affine"
+            ux = 0 if width == 1 else 1 / (width - 1)
+            uy = 0 if height == 1 else 1 / (height - 1)
+            h = [(tr[0] - tl[0]) * ux, (bl[0] - tl[0]) * uy, tl[0],
+                 (tr[1] - tl[1]) * ux, (bl[1] - tl[1]) * uy, tl[1],
+                 0.0, 0.0, 1.0]
+        elif br:
+            self.mode = "axis"
+            sx = 0 if width == 1 else (br[0] - tl[0]) / (width - 1)
+            sy = 0 if height == 1 else (br[1] - tl[1]) / (height - 1)
+            h = [sx, 0.0, tl[0], 0.0, sy, tl[1], 0.0, 0.0, 1.0]
+        else:
+            raise ValueError("need TL with BR or with TR and BL")
+        self.matrix = h
+        self.xs, self.ys = self._build_table(h)
+
+    def _build_table(self, h):
+        w, ht = self.width, self.height
+        if np is not None:
+            gx, gy = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(ht, dtype=np.float64))
+            d = h[6] * gx + h[7] * gy + h[8]
+            sx = np.rint((h[0] * gx + h[1] * gy + h[2]) / d).astype(np.int32).ravel()
+            sy = np.rint((h[3] * gx + h[4] * gy + h[5]) / d).astype(np.int32).ravel()
+            return array('i', sx.tobytes()), array('i', sy.tobytes())
+        xs = array('i')
+        ys = array('i')
+        for y in range(ht):
+            for x in range(w):
+                d = h[6] * x + h[7] * y + h[8]
+                xs.append(int(round((h[0] * x + h[1] * y + h[2]) / d)))
+                ys.append(int(round((h[3] * x + h[4] * y + h[5]) / d)))
+        return xs, ys
+
+    def __call__(self, x, y):
+        i = y * self.width + x
+        return self.xs[i], self.ys[i]
+
+# --- Screen capture and verification ---
+class ScreenCapture:
+    """Grabs a screen rectangle; swapped for ImageCapture when testing"""
+
+    def grab(self, box):
+        """RGB image of box = (left, top, right, bottom) in screen pixels"""
+        raise NotImplementedError
+
+class PyAutoGuiCapture(ScreenCapture):
+    def grab(self, box):
+        left, top, right, bottom = box
+        shot = get_pyautogui().screenshot(region=(left, top, right - left, bottom - top))
+        return shot.convert("RGB")
+
+class ImageCapture(ScreenCapture):
+    """Serves captures from an image (e.g. a saved screenshot) placed at `origin`"""
+
+    def __init__(self, image, origin=(0, 0)):
+        if isinstance(image, str):
+            image = Image.open(image)
+        self.image = image.convert("RGB")
+        self.origin = origin
+
+    def grab(self, box):
+        ox, oy = self.origin
+        left, top, right, bottom = box
+        return self.image.crop((left - ox, top - oy, right - ox, bottom - oy))
+
+def diff_cells(qimg, mask, grid, capture, tol=24):
+    """Cells whose on-screen color differs from `qimg` (PixelSet, row-major).
+
+    The canvas is captured once; each cell center from `grid` is compared
+    with its palette color, a cell matching when no channel is off by more
+    than `tol`.
+    """
+    cells = PixelSet.from_indexed(qimg, mask)
+    if not len(cells):
+        return cells
+    w = grid.width
+    pos = [y * w + x for x, y in zip(cells.xs, cells.ys)]
+    screen_x = [grid.xs[i] for i in pos]
+    screen_y = [grid.ys[i] for i in pos]
+    left, top = min(screen_x), min(screen_y)
+    shot = capture.grab((left, top, max(screen_x) + 1, max(screen_y) + 1))
+    rgb = [hex_to_rgb(hx) for hx in qimg.palette]
+    if np is not None:
+        arr = np.asarray(shot, dtype=np.int16)
+        sample = arr[np.array(screen_y) - top, np.array(screen_x) - left]
+        colors = np.frombuffer(cells.colors.tobytes(),
+                               dtype=np.uint8 if cells.colors.typecode == 'B' else np.uint16)
+        target = np.array(rgb, dtype=np.int16)[colors]
+        bad = np.flatnonzero(np.abs(sample - target).max(axis=1) > tol)
+        return cells.take(bad.tolist())
+    px = shot.load()
+    bad = []
+    for i, (sx, sy, c) in enumerate(zip(screen_x, screen_y, cells.colors)):
+        r, g, b = px[sx - left, sy - top][:3]
+        tr, tg, tb = rgb[c]
+        if max(abs(r - tr), abs(g - tg), abs(b - tb)) > tol:
+            bad.append(i)
+    return cells.take(bad)
+
+# --- Draw journal ---
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".wplace_drawer", "journal")
+
+def plan_key(qimg, mask, grid):
+    """Hash identifying a quantized plan drawn with a given calibration"""
+    import hashlib
+    h = hashlib.sha1()
+    h.update(repr((qimg.size, qimg.palette, grid.key if grid is not None else None)).encode())
+    h.update(qimg.indices.tobytes())
+    if mask is not None:
+        h.update(bytes(mask.bits))
+    return h.hexdigest()
+
+class DrawJournal:
+    """Append-only log of clicked cells, so a stopped run can be resumed.
+
+    File layout: b"WPJ1" + 20-byte plan key digest, then one little-endian
+    uint32 cell index (y * width + x) per click. Records are buffered and
+    fsynced in batches; a torn trailing record left by a crash is ignored.
+    """
+
+    MAGIC = b"WPJ1"
+    BATCH = 256  # records per fsync
+    INTERVAL = 2.0  # ...or at least this often, in seconds
+
+    def __init__(self, key, directory=JOURNAL_DIR):
+        self.key = key
+        self.path = os.path.join(directory, key + ".wpj")
+        self._header = self.MAGIC + bytes.fromhex(key)
+        self._pending = array('I')
+        self._last_sync = time.monotonic()
+        self._f = None
+
+    def load(self):
+        """Set of cell indices recorded for this plan (empty if none/foreign)"""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return set()
+        if not data.startswith(self._header):
+            return set()
+        body = data[len(self._header):]
+        done = array('I')
+        done.frombytes(body[:len(body) - len(body) % done.itemsize])
+        if sys.byteorder == "big":
+            done.byteswap()
+        return set(done)
+
+    def open(self, fresh=False):
+        """Start appending; `fresh` discards what was recorded before"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        valid = not fresh and self._header_ok()
+        self._f = open(self.path, "ab" if valid else "wb")
+        if not valid:
+            self._f.write(self._header)
+            self._sync()
+        else:
+            # drop a torn record so new ones stay aligned
+            size = os.path.getsize(self.path)
+            torn = (size - len(self._header)) % self._pending.itemsize
+            if torn:
+                self._f.truncate(size - torn)
+        return self
+
+    def _header_ok(self):
+        try:
+            with open(self.path, "rb") as f:
+                return f.read(len(self._header)) == self._header
+        except OSError:
+            return False
+
+    def record(self, index):
+        self._pending.append(index)
+        if len(self._pending) >= self.BATCH or time.monotonic() - self._last_sync >= self.INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self._f is None:
+            return
+        if self._pending:
+            if sys.byteorder == "big":
+                self._pending.byteswap()
+            self._f.write(self._pending.tobytes())
+            self._pending = array('I')
+        self._sync()
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._f is not None:
+            self.flush()
+            self._f.close()
+            self._f = None
+
+# --- Charge budget ---
+class ChargeBudget:
+    """Token bucket of pixel charges: up to `capacity`, one regenerates per `regen` seconds.
+
+    `clock()` returns seconds and `sleep(seconds)` returns True when the wait
+    was interrupted; both are injectable so schedules can be tested without
+    real time passing (the app passes its stop event's wait()).
+    """
+
+    def __init__(self, capacity, regen, tokens=None, clock=time.monotonic, sleep=None):
+        self.capacity = max(1, int(capacity))
+        self.regen = float(regen)
+        self.tokens = self.capacity if tokens is None else max(0, min(self.capacity, int(tokens)))
+        self.clock = clock
+        self.sleep = sleep or (lambda seconds: time.sleep(seconds) or False)
+        self._last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        if self.regen <= 0:  # no regeneration limit
+            self.tokens = self.capacity
+        if self.tokens >= self.capacity:
+            self._last = now
+            return
+        gained = int((now - self._last) // self.regen)
+        if gained:
+            self.tokens = min(self.capacity, self.tokens + gained)
+            self._last = now if self.tokens >= self.capacity else self._last + gained * self.regen
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+    def wait_time(self):
+        """Seconds until the next charge can be spent (0 if one is ready)"""
+        if self.available() >= 1:
+            return 0.0
+        return max(0.0, self._last + self.regen - self.clock())
+
+    def acquire(self, on_wait=None):
+        """Spend one charge, idling until one regenerates; False if the wait was interrupted"""
+        while True:
+            delay = self.wait_time()
+            if delay <= 0:
+                self.tokens -= 1
+                return True
+            if on_wait is not None:
+                on_wait(delay)
+            # wake up at least every second so on_wait can refresh the countdown
+            if self.sleep(min(delay, 1.0)):
+                return False
+
+    def time_to_paint(self, n, click_time):
+        """Predicted seconds to spend `n` charges at `click_time` per click.
+
+        Click k (0-based) can start no earlier than k * click_time nor before
+        its charge exists: at once for the first `tokens`, then one per
+        `regen` - so the run ends at max(n*c, (n - tokens)*regen + c).
+        """
+        tokens = self.available()
+        if n <= 0:
+            return 0.0
+        if n <= tokens or self.regen <= 0:
+            return n * click_time
+        first_wait = max(0.0, self._last + self.regen - self.clock())
+        return max(n * click_time, first_wait + (n - tokens - 1) * self.regen + click_time)
+
+# --- Image -> plan pipeline ---
+def detect_bg_color(img_rgba):
+    """Background candidate: the most opaque of the four corner pixels"""
+    w, h = img_rgba.size
+    px = img_rgba.load()
+    corners = [px[0, 0], px[w - 1, 0], px[0, h - 1], px[w - 1, h - 1]]
+    corners.sort(key=lambda p: p[3], reverse=True)
+    return corners[0]
+
+def crop_empty_margins(img_rgba, alpha_thr, tol):
+    """Trim transparent/background margins; returns (image, (left, top) offset)"""
+    bg = detect_bg_color(img_rgba)
+    box = content_bbox(img_rgba, bg, alpha_thr, tol)
+    if box is None:
+        return img_rgba, (0, 0)  # fully empty
+    return img_rgba.crop(box), (box[0], box[1])
+
+def compute_fit_size(w_req, h_req, limit, src_w, src_h, auto_maximize=True):
+    """Grid size for the requested W x H under the cell limit.
+
+    Without `auto_maximize` the request is only scaled down to fit; with it
+    the largest grid with the source aspect ratio under `limit` is searched.
+    """
+    if not auto_maximize:
+        # clamp to limit if necessary by scaling down proportionally
+        if w_req * h_req > limit:
+            scale = (limit / (w_req * h_req)) ** 0.5
+            w = max(1, int(w_req * scale))
+            h = max(1, int(h_req * scale))
+            return w, h
+        return w_req, h_req
+    aspect = src_w / src_h if src_h != 0 else 1.0
+    # try base on width
+    w = max(1, w_req)
+    h = max(1, int(round(w / aspect)))
+    if w * h > limit:
+        # reduce until within limit
+        scale = (limit / (w * h)) ** 0.5
+        w = max(1, int(w * scale))
+        h = max(1, int(round(w / aspect)))
+    # try to grow until limit
+    improved = True
+    while improved:
+        improved = False
+        if (w + 1) * int(round((w + 1) / aspect)) <= limit:
+            w += 1
+            h = max(1, int(round(w / aspect)))
+            improved = True
+        elif (h + 1) * int(round((h + 1) * aspect)) <= limit:
+            h += 1
+            w = max(1, int(round(h * aspect)))
+            improved = True
+    return w, h
+
+class GridLimitError(ValueError):
+    """The fitted grid has more cells than ConvertOptions.limit allows"""
+
+@dataclass
+class ConvertOptions:
+    """Settings of the image -> plan pipeline (mirrors the app's top bar)"""
+    width: int = 8
+    height: int = 8
+    limit: int = 62
+    alpha_thr: int = 10
+    bg_tolerance: int = 12
+    trim: bool = True
+    auto_maximize: bool = True
+    dither: bool = False
+    dither_mode: str = "floyd-steinberg"
+    serpentine: bool = False
+
+@dataclass
+class ConvertResult:
+    scaled: "Image.Image"  # RGBA at grid size
+    quant: IndexedImage
+    mask: DrawMask
+    offset: tuple  # (left, top) trimmed off the source
+
+def convert_image(src, opts, lut=None, progress=None):
+    """Trim, fit under the limit, resize and quantize one image.
+
+    `lut` pins the palette (default: the current one), so a caller on
+    another thread is not affected by later set_palette calls.
+    `progress(stage, fraction)` is called between stages and during error
+    diffusion; an exception raised from it aborts the conversion.
+    Raises GridLimitError when the fitted grid still exceeds `opts.limit`.
+    """
+    report = progress or (lambda stage, fraction: None)
+    report("Подготовка", 0.0)
+    img = src.convert("RGBA")
+    offset = (0, 0)
+    if opts.trim:
+        report("Обрезка полей", 0.0)
+        img, offset = crop_empty_margins(img, opts.alpha_thr, opts.bg_tolerance)
+    w, h = compute_fit_size(opts.width, opts.height, opts.limit, img.width, img.height, opts.auto_maximize)
+    if w * h > opts.limit:
+        raise GridLimitError(f"{w}x{h} = {w*h} > лимита {opts.limit}")
+    report("Масштабирование", 0.0)
+    scaled = img.resize((w, h), Image.NEAREST)
+    report("Квантование", 0.0)
+    quant, mask = quantize_image(scaled, opts.alpha_thr, opts.dither, opts.dither_mode, opts.serpentine, lut,
+                                 lambda fraction: report("Квантование", fraction))
+    return ConvertResult(scaled, quant, mask, offset)
+
+def read_palette_json(path):
+    """Hex list from a palette file: {"palette": [...]} or a bare list"""
+    import json
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict) and 'palette' in data:
+        return data['palette']
+    return data
+
+def write_pixels_csv(path, pixels):
+    import csv
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        wcsv = csv.writer(f)
+        wcsv.writerow(["x", "y", "hex_color"])  # header
+        palette = pixels.palette
+        wcsv.writerows((x, y, palette[c]) for x, y, c in zip(pixels.xs, pixels.ys, pixels.colors))
+
+def write_pixels_json(path, pixels, size):
+    import json
+    w, h = size
+    payload = {
+        "width": w,
+        "height": h,
+        "pixels": [
+            {"x": x, "y": y, "hex_color": pixels.palette[c]}
+            for x, y, c in zip(pixels.xs, pixels.ys, pixels.colors)
+        ],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
@@ -1,278 +1,29 @@
-import threading
 import time
+_T_START = time.perf_counter()  # startup timing reference, see main()
+import threading
 import os
-import csv
+import sys
 import json
-import random
-import math
-from dataclasses import dataclass
-from collections import defaultdict
 from tkinter import (
     Tk, Frame, Label, Button, Entry, StringVar, Listbox, SINGLE,
     filedialog, messagebox, Canvas, Scrollbar, END, ttk
 )
-from PIL import Image, ImageTk
-
-# External control
-try:
-    import pyautogui
-    pyautogui.FAILSAFE = True  # move mouse to (0,0) to abort
-except Exception:
-    pyautogui = None
-
-# Enhanced site palette with better color coverage for improved matching
-SITE_PALETTE = [
-    # Extended grayscale range
-    "#000000", "#111111", "#222222", "#333333", "#444444", "#555555", 
-    "#666666", "#777777", "#888888", "#999999", "#AAAAAA", "#BBBBBB", 
-    "#CCCCCC", "#DDDDDD", "#EEEEEE", "#FFFFFF",
-    
-    # Deep reds to bright reds
-    "#4A0E11", "#6A0015", "#8B1538", "#B91C3C", "#DC2626", "#E53935", 
-    "#EF4444", "#F87171", "#FCA5A5", "#FECACA",
-    
-    # Oranges with better transitions
-    "#7C2D12", "#9A3412", "#C2410C", "#EA580C", "#F0641E", "#F97316", 
-    "#FB923C", "#FDBA74", "#FED7AA", "#FFE4C4",
-    
-    # Yellows and warm tones
-    "#A16207", "#CA8A04", "#EAB308", "#F4A300", "#FACC15", "#FDE047", 
-    "#FEF08A", "#FEFCE8", "#FFE98A", "#FFFBEB",
-    
-    # Green spectrum expanded
-    "#14532D", "#166534", "#15803D", "#16A34A", "#1E8E3E", "#22C55E", 
-    "#27AE60", "#4ADE80", "#5BE36C", "#86EFAC", "#BBF7D0", "#DCFCE7",
-    
-    # Teals and cyans
-    "#0F4C4C", "#0F766E", "#0D9488", "#0E8A6A", "#14B8A6", "#17BEBB", 
-    "#2DD4BF", "#5EEAD4", "#99F6E4", "#CCFBF1",
-    
-    # Blues comprehensive range
-    "#0C4A6E", "#075985", "#0369A1", "#0284C7", "#0096C7", "#0EA5E9", 
-    "#1E40AF", "#2563EB", "#3B82F6", "#60A5FA", "#7C83FF", "#93C5FD", 
-    "#BFDBFE", "#DBEAFE", "#7DD3FC",
-    
-    # Sky and light blues
-    "#0284C7", "#0EA5E9", "#22B8CF", "#38BDF8", "#7DD3FC", "#BAE6FD", 
-    "#E0F2FE", "#F0F9FF",
-    
-    # Purples extended
-    "#4C1D95", "#5B21B6", "#6D28D9", "#7C3AED", "#7E22CE", "#8B5CF6", 
-    "#8E44AD", "#A855F7", "#C084FC", "#D8B4FE", "#E9D5FF", "#FAF5FF",
-    
-    # Pinks and magentas
-    "#831843", "#9D174D", "#BE185D", "#C2185B", "#E91E63", "#EC4899", 
-    "#F472B6", "#F9A8D4", "#FBCFE8", "#FCE7F3",
-    
-    # Violets
-    "#6B21A8", "#7E22CE", "#8B5A96", "#9B59B6", "#A855F7", "#B794F6", 
-    "#C4A8E8", "#DDD6FE", "#EDE9FE",
-    
-    # Browns and earth tones
-    "#451A03", "#54350A", "#6B3F2C", "#78350F", "#8D5A3A", "#92400E", 
-    "#A16207", "#B45309", "#D97706", "#E6A57E", "#FBBF24",
-    
-    # Peach and coral tones
-    "#FF6B6B", "#FF8E8E", "#FFB38A", "#FFC5A3", "#FFD7BB", "#FFE9D4", 
-    "#FFF2E7", "#FFFAF5",
-    
-    # Additional useful colors
-    "#2F1B69", "#3730A3", "#4338CA", "#5147E5", "#6366F1", "#818CF8", 
-    "#A78BFA", "#C7D2FE", "#E0E7FF"
-]
-
-@dataclass
-class Pixel:
-    x: int
-    y: int
-    hex_color: str
-
-def rgb_to_hex(rgb):
-    r, g, b = rgb[:3]
-    return f"#{r:02X}{g:02X}{b:02X}"
-
-def hex_to_rgb(hx: str):
-    hx = hx.lstrip('#')
-    return tuple(int(hx[i:i+2], 16) for i in (0, 2, 4))
-
-# --- Color science helpers (OKLab) for perceptual distance ---
-# Reference: https://bottosson.github.io/posts/oklab/
-
-def _srgb_to_linear(c: float) -> float:
-    c = c / 255.0
-    if c <= 0.04045:
-        return c / 12.92
-    return ((c + 0.055) / 1.055) ** 2.4
-
-def _linear_to_oklab(r: float, g: float, b: float):
-    # r,g,b are linear [0..1]
-    l = 0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b
-    m = 0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b
-    s = 0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b
-    l_ = l ** (1/3)
-    m_ = m ** (1/3)
-    s_ = s ** (1/3)
-    L = 0.2104542553 * l_ + 0.7936177850 * m_ - 0.0040720468 * s_
-    a = 1.9779984951 * l_ - 2.4285922050 * m_ + 0.4505937099 * s_
-    b2 = 0.0259040371 * l_ + 0.7827717662 * m_ - 0.8086757660 * s_
-    return (L, a, b2)
-
-def _rgb_to_oklab(r: int, g: int, b: int):
-    rl = _srgb_to_linear(r)
-    gl = _srgb_to_linear(g)
-    bl = _srgb_to_linear(b)
-    return _linear_to_oklab(rl, gl, bl)
-
-def _oklab_dist(c1, c2):
-    dL = c1[0] - c2[0]
-    da = c1[1] - c2[1]
-    db = c1[2] - c2[2]
-    return dL*dL + da*da + db*db
-
-# --- Additional color distance algorithms ---
-
-def _rgb_euclidean_distance(c1, c2):
-    """Simple RGB Euclidean distance"""
-    dr = c1[0] - c2[0]
-    dg = c1[1] - c2[1]
-    db = c1[2] - c2[2]
-    return dr*dr + dg*dg + db*db
-
-def _xyz_to_lab(x, y, z):
-    """Convert XYZ to Lab color space for Delta E CIE76"""
-    # Observer: 2°, Illuminant: D65
-    xn, yn, zn = 0.95047, 1.00000, 1.08883
-    
-    x = x / xn
-    y = y / yn
-    z = z / zn
-    
-    def f(t):
-        return t**(1/3) if t > 0.008856 else (7.787 * t + 16/116)
-    
-    fx = f(x)
-    fy = f(y)
-    fz = f(z)
-    
-    L = 116 * fy - 16
-    a = 500 * (fx - fy)
-    b = 200 * (fy - fz)
-    
-    return L, a, b
-
-def _rgb_to_xyz(r, g, b):
-    """Convert RGB to XYZ color space"""
-    # Normalize RGB values to [0,1]
-    r = r / 255.0
-    g = g / 255.0
-    b = b / 255.0
-    
-    # Apply gamma correction
-    def gamma_correct(c):
-        if c > 0.04045:
-            return ((c + 0.055) / 1.055) ** 2.4
-        else:
-            return c / 12.92
-    
-    r = gamma_correct(r)
-    g = gamma_correct(g)
-    b = gamma_correct(b)
-    
-    # Convert to XYZ using sRGB matrix
-    x = r * 0.4124564 + g * 0.3575761 + b * 0.1804375
-    y = r * 0.2126729 + g * 0.7151522 + b * 0.0721750
-    z = r * 0.0193339 + g * 0.1191920 + b * 0.9503041
-    
-    return x, y, z
-
-def _rgb_to_lab(r, g, b):
-    """Convert RGB to Lab color space"""
-    x, y, z = _rgb_to_xyz(r, g, b)
-    return _xyz_to_lab(x, y, z)
-
-def _delta_e_cie76(lab1, lab2):
-    """Delta E CIE76 color difference"""
-    dL = lab1[0] - lab2[0]
-    da = lab1[1] - lab2[1]
-    db = lab1[2] - lab2[2]
-    return (dL*dL + da*da + db*db) ** 0.5
-
-# Color distance algorithm globals
-COLOR_ALGORITHM = "oklab"  # options: "oklab", "deltaE", "rgb"
-
-# Current palette (mutable) and precomputed arrays
-CURRENT_PALETTE = list(SITE_PALETTE)
-_PALETTE_RGB = [hex_to_rgb(hx) for hx in CURRENT_PALETTE]
-_PALETTE_LAB = [_rgb_to_oklab(*rgb) for rgb in _PALETTE_RGB]
-_PALETTE_CIE_LAB = [_rgb_to_lab(*rgb) for rgb in _PALETTE_RGB]
-
-def set_palette(hex_list):
-    global CURRENT_PALETTE, _PALETTE_RGB, _PALETTE_LAB, _PALETTE_CIE_LAB
-    # sanitize and unique while preserving order
-    seen = set()
-    cleaned = []
-    for hx in hex_list:
-        if not isinstance(hx, str):
-            continue
-        if not hx.startswith('#'):
-            hx = '#' + hx
-        hx = hx[:7].upper()
-        if len(hx) != 7:
-            continue
-        if hx in seen:
-            continue
-        seen.add(hx)
-        cleaned.append(hx)
-    if cleaned:
-        CURRENT_PALETTE = cleaned
-        _PALETTE_RGB = [hex_to_rgb(hx) for hx in CURRENT_PALETTE]
-        _PALETTE_LAB = [_rgb_to_oklab(*rgb) for rgb in _PALETTE_RGB]
-        _PALETTE_CIE_LAB = [_rgb_to_lab(*rgb) for rgb in _PALETTE_RGB]
-
-def get_palette():
-    return list(CURRENT_PALETTE)
-
-def set_color_algorithm(algorithm: str):
-    """Set the color distance algorithm to use"""
-    global COLOR_ALGORITHM
-    if algorithm in ["oklab", "deltaE", "rgb"]:
-        COLOR_ALGORITHM = algorithm
-
-def nearest_palette_color(r: int, g: int, b: int) -> str:
-    """Find the closest palette color using the selected algorithm"""
-    global COLOR_ALGORITHM
-    
-    best_i = 0
-    best_d = 1e9
-    
-    if COLOR_ALGORITHM == "oklab":
-        # Use OKLab distance (perceptual)
-        lab = _rgb_to_oklab(r, g, b)
-        for i, labp in enumerate(_PALETTE_LAB):
-            d = _oklab_dist(lab, labp)
-            if d < best_d:
-                best_d = d
-                best_i = i
-    
-    elif COLOR_ALGORITHM == "deltaE":
-        # Use Delta E CIE76
-        lab = _rgb_to_lab(r, g, b)
-        for i, labp in enumerate(_PALETTE_CIE_LAB):
-            d = _delta_e_cie76(lab, labp)
-            if d < best_d:
-                best_d = d
-                best_i = i
-    
-    elif COLOR_ALGORITHM == "rgb":
-        # Use simple RGB Euclidean distance
-        rgb = (r, g, b)
-        for i, rgbp in enumerate(_PALETTE_RGB):
-            d = _rgb_euclidean_distance(rgb, rgbp)
-            if d < best_d:
-                best_d = d
-                best_i = i
-    
-    return CURRENT_PALETTE[best_i]
+
+# Core is import-light: Pillow (Image), numpy and pyautogui load on first use
+from wplace_core import (
+    CellGrid, ChargeBudget, ColorIndex, ConvertOptions, DIFFUSION_KERNELS, DrawCostModel, DrawJournal,
+    GridLimitError, INPUT_DRIVERS, Image, ORDERED_DITHER_MODES, PixelSet, PyAutoGuiCapture, PyAutoGuiDriver, REGION_SPLITS,
+    SITE_PALETTE, STROKE_ORDERS, SWATCH_MATCH_TOL, SwatchIndex, TurboDriver, ZOOM_LEVELS,
+    convert_image, detect_swatches, diff_cells, format_duration, get_palette, get_palette_lut,
+    get_pyautogui, kmeans_palette, plan_color_sequence, plan_key, plan_strokes, predict_sequence_duration,
+    read_palette_json, render_preview_region, rgb_to_hex, set_color_algorithm, set_palette,
+    write_pixels_csv, write_pixels_json,
+)
+_T_IMPORTED = time.perf_counter()
+
+class _Superseded(Exception):
+    """Raised inside a pipeline run once a newer request has been made"""
+
 
 class ScrollableFrame(Frame):
     def __init__(self, parent, width=320, height=500):
@@ -301,6 +52,9 @@ class ScrollableFrame(Frame):
 
 
 class WplaceDrawerApp:
+    PREVIEW_TILE_PX = 256  # preview tile side on screen
+    PREVIEW_TILE_CACHE = 64  # rendered tiles kept; a few screens' worth
+
     def __init__(self, root):
         self.root = root
         self.root.title("Wplace Drawer (Testing Mode)")
@@ -323,14 +77,25 @@ class WplaceDrawerApp:
         self.src_image_path = None
         self.src_image = None  # PIL Image RGBA
         self.scaled_image = None  # PIL Image RGBA
-        self.quant_image = None  # PIL Image after palette mapping
-        self.preview_image = None  # ImageTk in canvas
-        self.draw_mask = None  # 2D bool mask: True -> draw, False -> transparent/skip
+        self.quant_image = None  # IndexedImage after palette mapping
+        self._tile_items = {}  # (tx, ty) -> (canvas item, PhotoImage) currently shown
+        self._tile_cache = {}  # (zoom, tx, ty, highlight) -> PhotoImage, oldest first
+        self._preview_source = None  # quant_image the cache was rendered from
+        self._view_zoom = None  # screen px per cell, one of ZOOM_LEVELS
+        self._view_x = self._view_y = 0.0  # cell at the canvas' top-left corner
+        self._view_fit = True  # refit on resize until the user zooms or pans
+        self._pan_anchor = None
+        self._zoom_label = None
+        self._preview_after = None  # pending debounced refresh
+        self.draw_mask = None  # DrawMask: set -> draw, clear -> transparent/skip
+        self.color_index = None  # ColorIndex of quant_image, rebuilt on every re-quantize
         self.transparent_bg = (235, 235, 235)  # preview background for transparent cells
         # Options
         self.trim_margins = StringVar(value="1")  # "1" to enable auto-cropping of empty margins
         self.auto_maximize = StringVar(value="1")  # "1" to auto-maximize under limit
-        self.enable_dither = StringVar(value="0")  # Floyd–Steinberg dithering
+        self.enable_dither = StringVar(value="0")  # error-diffusion dithering
+        self.dither_mode_var = StringVar(value="floyd-steinberg")  # DIFFUSION_KERNELS or ORDERED_DITHER_MODES key
+        self.serpentine_var = StringVar(value="0")  # alternate scan direction per row
         self.alpha_threshold = StringVar(value="10")  # transparency threshold 0..255
         self.bg_tolerance = StringVar(value="12")  # background tolerance (0..255) for solid bg detection
 
@@ -345,6 +110,11 @@ class WplaceDrawerApp:
         self.tr = None  # (x, y)
         self.bl = None  # (x, y)
         self.br = None  # (x, y)
+        self._cell_grid = None  # CellGrid cached for the calibration above
+        self._journal = None  # DrawJournal of the running draw thread
+        self._budget = None  # ChargeBudget of the running draw thread
+        self._cells_left = 0  # clicks still queued in the running draw thread
+        self._click_time = 0.0  # predicted seconds per click for that thread
 
         # Palette used for quantization (starts with default)
         set_palette(SITE_PALETTE)
@@ -353,14 +123,37 @@ class WplaceDrawerApp:
         # Palette area (for auto-search): top-left, bottom-right
         self.pal_tl = None
         self.pal_br = None
+        self._swatch_index = None  # SwatchIndex of the palette area, reset per drawing session
         # Color distance algorithm variable
         self.color_algorithm_var = StringVar(value="oklab")
         # Highlight selected color on preview
         self.highlight_color = None
 
+        # Cell visiting order inside a color (see STROKE_ORDERS)
+        self.stroke_order_var = StringVar(value="raster")
+        # Click backend, key of INPUT_DRIVERS
+        self.input_driver_var = StringVar(value=PyAutoGuiDriver.name)
+        # Verify/repair: per-channel tolerance and number of diff+draw passes
+        self.verify_tol_var = StringVar(value="24")
+        self.repair_passes_var = StringVar(value="2")
+        self.screen_capture = PyAutoGuiCapture()  # replace with ImageCapture to test offline
+        # Charge budget: site limit on stored pixel charges and their regeneration
+        self.budget_enabled_var = StringVar(value="0")
+        self.budget_capacity_var = StringVar(value="30")
+        self.budget_tokens_var = StringVar(value="30")  # charges available now
+        self.budget_regen_var = StringVar(value="30")  # seconds per charge
+        # Canvas split for "draw all colors": "NxN" from REGION_SPLITS or "авто"
+        self.regions_var = StringVar(value="1x1")
+
         # Drawing thread control
         self._draw_thread = None
+        self._plan_thread = None  # draw_all_colors / resume planning off the Tk thread
         self._stop_flag = threading.Event()
+        # Background conversion: only the newest request (generation) is delivered
+        self._pipeline_gen = 0
+        self._pipeline_job = None  # (gen, src, opts, lut) waiting for the worker
+        self._pipeline_thread = None
+        self._pipeline_lock = threading.Lock()
 
         # UI layout
         top = Frame(root)
@@ -382,11 +175,19 @@ class WplaceDrawerApp:
         Checkbutton(top, text="Обрезать поля", variable=self.trim_margins, onvalue="1", offvalue="0").pack(side="left")
         Checkbutton(top, text="Авто-максимум", variable=self.auto_maximize, onvalue="1", offvalue="0").pack(side="left")
         Checkbutton(top, text="Дизеринг", variable=self.enable_dither, onvalue="1", offvalue="0").pack(side="left")
+        ttk.Combobox(top, textvariable=self.dither_mode_var,
+                     values=list(DIFFUSION_KERNELS) + list(ORDERED_DITHER_MODES),
+                     state="readonly", width=14).pack(side="left", padx=(2, 0))
+        Checkbutton(top, text="Змейка", variable=self.serpentine_var, onvalue="1", offvalue="0").pack(side="left")
 
         Label(top, text="Стартовая задержка, c:").pack(side="left", padx=(10, 4))
         Entry(top, textvariable=self.delay_var, width=6).pack(side="left")
         Label(top, text="Пауза между кликами, c:").pack(side="left", padx=(10, 4))
         Entry(top, textvariable=self.click_sleep_var, width=6).pack(side="left")
+        Label(top, text="Ввод:").pack(side="left", padx=(10, 4))
+        ttk.Combobox(top, textvariable=self.input_driver_var,
+                     values=[PyAutoGuiDriver.name, TurboDriver.name],
+                     state="readonly", width=10).pack(side="left")
 
         # Info
         self.info_var = StringVar(value="Откройте изображение и задайте размеры (W*H ≤ 62)")
@@ -404,7 +205,13 @@ class WplaceDrawerApp:
         mid.pack(fill="both", expand=True)
         self.canvas = Canvas(mid, bg="#2b2b2b")
         self.canvas.pack(side="left", fill="both", expand=True, padx=10, pady=10)
-        self.canvas.bind("<Configure>", self.refresh_preview)
+        self.canvas.bind("<Configure>", self.schedule_preview)
+        self.canvas.bind("<MouseWheel>", self._on_preview_wheel)
+        self.canvas.bind("<Button-4>", self._on_preview_wheel)
+        self.canvas.bind("<Button-5>", self._on_preview_wheel)
+        self.canvas.bind("<ButtonPress-1>", self._on_pan_start)
+        self.canvas.bind("<B1-Motion>", self._on_pan_drag)
+        self.canvas.bind("<Double-Button-1>", self.fit_preview)
 
         # Right panel (scrollable)
         right_scroll = ScrollableFrame(mid, width=320, height=620)
@@ -462,8 +269,37 @@ class WplaceDrawerApp:
         Button(right, text="Сохранить палитру JSON", command=self.save_palette_json).pack(fill="x", padx=6, pady=2)
 
         Label(right, text="Отрисовка:").pack(anchor="w", padx=6, pady=(12, 4))
+        order_frame = Frame(right)
+        order_frame.pack(fill="x", padx=6)
+        Label(order_frame, text="Порядок обхода:").pack(side="left")
+        ttk.Combobox(order_frame, textvariable=self.stroke_order_var, values=list(STROKE_ORDERS),
+                     state="readonly", width=10).pack(side="left", padx=(4, 0))
+        region_frame = Frame(right)
+        region_frame.pack(fill="x", padx=6, pady=(2, 0))
+        Label(region_frame, text="Регионы (все цвета):").pack(side="left")
+        ttk.Combobox(region_frame, textvariable=self.regions_var,
+                     values=["авто"] + [f"{n}x{n}" for n in REGION_SPLITS],
+                     state="readonly", width=6).pack(side="left", padx=(4, 0))
         Button(right, text="Нарисовать выбранный цвет", command=self.draw_selected_color).pack(fill="x", padx=6, pady=2)
         Button(right, text="Нарисовать все цвета (по порядку)", command=self.draw_all_colors).pack(fill="x", padx=6, pady=2)
+        repair_frame = Frame(right)
+        repair_frame.pack(fill="x", padx=6, pady=(2, 0))
+        Label(repair_frame, text="Допуск:").pack(side="left")
+        Entry(repair_frame, textvariable=self.verify_tol_var, width=4).pack(side="left", padx=(2, 6))
+        Label(repair_frame, text="Проходов:").pack(side="left")
+        Entry(repair_frame, textvariable=self.repair_passes_var, width=3).pack(side="left", padx=(2, 0))
+        budget_frame = Frame(right)
+        budget_frame.pack(fill="x", padx=6, pady=(2, 0))
+        Checkbutton(budget_frame, text="Заряды", variable=self.budget_enabled_var,
+                    onvalue="1", offvalue="0").pack(side="left")
+        Entry(budget_frame, textvariable=self.budget_tokens_var, width=4).pack(side="left")
+        Label(budget_frame, text="/").pack(side="left")
+        Entry(budget_frame, textvariable=self.budget_capacity_var, width=4).pack(side="left")
+        Label(budget_frame, text="по").pack(side="left", padx=(4, 2))
+        Entry(budget_frame, textvariable=self.budget_regen_var, width=4).pack(side="left")
+        Label(budget_frame, text="с").pack(side="left", padx=(2, 0))
+        Button(right, text="Продолжить (Resume)", command=self.resume_drawing).pack(fill="x", padx=6, pady=2)
+        Button(right, text="Проверить и дорисовать", command=self.verify_and_repair).pack(fill="x", padx=6, pady=2)
         Button(right, text="Стоп", command=self.request_stop).pack(fill="x", padx=6, pady=(6, 2))
 
         Label(right, text="Подсказки:\nГорячие клавиши: F1-F4 - калибровка сетки\nF5-F6 - калибровка палитры, F7 - запомнить цвет\nF8 - стоп. Failsafe: мышь в левый верхний угол", justify="left").pack(anchor="w", padx=6, pady=(10, 6))
@@ -498,201 +334,116 @@ class WplaceDrawerApp:
         except Exception:
             return default
 
-    def _detect_bg_color(self, img_rgba, tol: int):
-        # Heuristic: use the top-left pixel (or median of 4 corners) as background candidate
-        w, h = img_rgba.size
-        px = img_rgba.load()
-        corners = [px[0,0], px[w-1,0], px[0,h-1], px[w-1,h-1]]
-        # pick the one with highest alpha as bg sample
-        corners.sort(key=lambda p: p[3], reverse=True)
-        r, g, b, a = corners[0]
-        return (r, g, b, a)
-
-    def _crop_empty_margins(self, img_rgba, alpha_thr: int, tol: int):
-        w, h = img_rgba.size
-        px = img_rgba.load()
-        bg = self._detect_bg_color(img_rgba, tol)
-        def is_empty(x, y):
-            r, g, b, a = px[x, y]
-            if a < alpha_thr:
-                return True
-            # close to bg color?
-            dr = abs(r - bg[0]); dg = abs(g - bg[1]); db = abs(b - bg[2])
-            return (dr + dg + db) <= 3 * tol
-        top = 0
-        while top < h and all(is_empty(x, top) for x in range(w)):
-            top += 1
-        if top == h:
-            return img_rgba, (0, 0)  # fully empty
-        bottom = h - 1
-        while bottom >= 0 and all(is_empty(x, bottom) for x in range(w)):
-            bottom -= 1
-        left = 0
-        while left < w and all(is_empty(left, y) for y in range(top, bottom+1)):
-            left += 1
-        right = w - 1
-        while right >= 0 and all(is_empty(right, y) for y in range(top, bottom+1)):
-            right -= 1
-        cropped = img_rgba.crop((left, top, right+1, bottom+1))
-        return cropped, (left, top)
-
-    def _compute_fit_size(self, w_req, h_req, limit, src_w, src_h):
-        # Preserve aspect ratio of src
-        if self.auto_maximize.get() != "1":
-            # clamp to limit if necessary by scaling down proportionally
-            if w_req * h_req > limit:
-                scale = (limit / (w_req * h_req)) ** 0.5
-                w = max(1, int(w_req * scale))
-                h = max(1, int(h_req * scale))
-                return w, h
-            return w_req, h_req
-        # Auto maximize: compute the largest integer (w,h) under limit with src aspect
-        aspect = src_w / src_h if src_h != 0 else 1.0
-        # try base on width
-        w = max(1, w_req)
-        h = max(1, int(round(w / aspect)))
-        if w * h > limit:
-            # reduce until within limit
-            scale = (limit / (w * h)) ** 0.5
-            w = max(1, int(w * scale))
-            h = max(1, int(round(w / aspect)))
-        # try to grow until limit
-        improved = True
-        while improved:
-            improved = False
-            if (w+1) * int(round((w+1) / aspect)) <= limit:
-                w += 1
-                h = max(1, int(round(w / aspect)))
-                improved = True
-            elif (h+1) * int(round((h+1) * aspect)) <= limit:
-                h += 1
-                w = max(1, int(round(h * aspect)))
-                improved = True
-        return w, h
-
-    def _quantize_to_palette(self, img_rgba, dither: bool, alpha_thr: int):
-        w, h = img_rgba.size
-        out = Image.new("RGB", (w, h))
-        dst = out.load()
-        src = img_rgba.load()
-        mask = [[False for _ in range(w)] for _ in range(h)]
-        if not dither:
-            for yy in range(h):
-                for xx in range(w):
-                    r, g, b, a = src[xx, yy]
-                    if a < alpha_thr:
-                        mask[yy][xx] = False
-                        dst[xx, yy] = self.transparent_bg
-                    else:
-                        mask[yy][xx] = True
-                        hx = nearest_palette_color(r, g, b)
-                        dst[xx, yy] = hex_to_rgb(hx)
-            return out, mask
-        # Floyd–Steinberg dithering in RGB space with perceptual mapping for target
-        err = [[(0.0, 0.0, 0.0) for _ in range(w)] for _ in range(h)]
-        for y in range(h):
-            for x in range(w):
-                r, g, b, a = src[x, y]
-                if a < alpha_thr:
-                    mask[y][x] = False
-                    dst[x, y] = self.transparent_bg
-                    continue
-                mask[y][x] = True
-                er, eg, eb = err[y][x]
-                nr = min(255, max(0, int(round(r + er))))
-                ng = min(255, max(0, int(round(g + eg))))
-                nb = min(255, max(0, int(round(b + eb))))
-                hx = nearest_palette_color(nr, ng, nb)
-                pr, pg, pb = hex_to_rgb(hx)
-                dst[x, y] = (pr, pg, pb)
-                dr = nr - pr; dg = ng - pg; db = nb - pb
-                # distribute error
-                def add_err(xx, yy, fr):
-                    if 0 <= xx < w and 0 <= yy < h:
-                        e0 = err[yy][xx]
-                        err[yy][xx] = (e0[0] + dr * fr, e0[1] + dg * fr, e0[2] + db * fr)
-                add_err(x+1, y,   7/16)
-                add_err(x-1, y+1, 3/16)
-                add_err(x,   y+1, 5/16)
-                add_err(x+1, y+1, 1/16)
-        return out, mask
+    def _convert_options(self):
+        return ConvertOptions(
+            width=self.get_int(self.width_var, 8),
+            height=self.get_int(self.height_var, 8),
+            limit=self.get_int(self.limit_var, 62),
+            alpha_thr=self.get_int(self.alpha_threshold, 10),
+            bg_tolerance=self.get_int(self.bg_tolerance, 12),
+            trim=self.trim_margins.get() == "1",
+            auto_maximize=self.auto_maximize.get() == "1",
+            dither=self.enable_dither.get() == "1",
+            dither_mode=self.dither_mode_var.get(),
+            serpentine=self.serpentine_var.get() == "1",
+        )
 
     def apply_resize(self):
+        """Re-run trimming, resizing and quantization in the background.
+
+        Options and the palette are captured now. Requests made while a run
+        is in progress replace the queued one and abort the running one, so
+        a burst of changes ends in a single delivered result.
+        """
         if self.src_image is None:
             messagebox.showinfo("Нет изображения", "Сначала откройте изображение")
             return
-        w_req = self.get_int(self.width_var, 8)
-        h_req = self.get_int(self.height_var, 8)
-        limit = self.get_int(self.limit_var, 62)
-        alpha_thr = self.get_int(self.alpha_threshold, 10)
-        tol = self.get_int(self.bg_tolerance, 12)
-        img = self.src_image.convert("RGBA")
-        # optional trim
-        offset = (0, 0)
-        if self.trim_margins.get() == "1":
-            img, offset = self._crop_empty_margins(img, alpha_thr, tol)
-        src_w, src_h = img.size
-        # compute fit size
-        w, h = self._compute_fit_size(w_req, h_req, limit, src_w, src_h)
-        if w * h > limit:
-            messagebox.showwarning("Лимит превышен", f"{w}x{h} = {w*h} > лимита {limit}")
+        self._pipeline_gen += 1
+        job = (self._pipeline_gen, self.src_image, self._convert_options(), get_palette_lut())
+        self.info_var.set("Обработка…")
+        with self._pipeline_lock:
+            self._pipeline_job = job
+            if self._pipeline_thread is None:
+                self._pipeline_thread = threading.Thread(target=self._pipeline_worker, daemon=True)
+                self._pipeline_thread.start()
+
+    def _pipeline_worker(self):
+        while True:
+            with self._pipeline_lock:
+                job, self._pipeline_job = self._pipeline_job, None
+                if job is None:
+                    self._pipeline_thread = None
+                    return
+            gen, src, opts, lut = job
+            shown = [None]
+
+            def progress(stage, fraction):
+                if gen != self._pipeline_gen:
+                    raise _Superseded()
+                msg = f"Обработка: {stage}…" if not fraction else f"Обработка: {stage} {int(fraction * 100)}%"
+                if msg != shown[0]:
+                    shown[0] = msg
+                    self.root.after(0, self._pipeline_progress, gen, msg)
+
+            try:
+                result = convert_image(src, opts, lut, progress)
+                progress("Индекс цветов", 0.0)
+                index = ColorIndex(result.quant, result.mask)
+            except _Superseded:
+                continue
+            except Exception as e:
+                self.root.after(0, self._pipeline_done, gen, opts, e, None)
+                continue
+            self.root.after(0, self._pipeline_done, gen, opts, result, index)
+
+    def _pipeline_progress(self, gen, msg):
+        if gen == self._pipeline_gen:
+            self.info_var.set(msg)
+
+    def _pipeline_done(self, gen, opts, result, index):
+        """Install a finished run on the Tk thread unless a newer one was requested"""
+        if gen != self._pipeline_gen:
             return
-        self.scaled_image = img.resize((w, h), Image.NEAREST)
-        # quantize
-        self.quant_image, self.draw_mask = self._quantize_to_palette(
-            self.scaled_image.convert("RGBA"),
-            dither=(self.enable_dither.get()=="1"),
-            alpha_thr=alpha_thr,
-        )
+        if isinstance(result, GridLimitError):
+            self.info_var.set("")
+            messagebox.showwarning("Лимит превышен", str(result))
+            return
+        if isinstance(result, Exception):
+            self.info_var.set("")
+            messagebox.showerror("Ошибка", f"Не удалось обработать изображение: {result}")
+            return
+        self.scaled_image = result.scaled
+        self.quant_image, self.draw_mask = result.quant, result.mask
+        self.color_index = index
         self.populate_colors()
         self.refresh_preview()
-        trim_note = " (обрезано)" if self.trim_margins.get()=="1" and (offset != (0,0)) else ""
+        w, h = self.scaled_image.size
+        trim_note = " (обрезано)" if opts.trim and result.offset != (0, 0) else ""
         self.info_var.set(f"Сетка {w}x{h} ({w*h}). Цветов: {self.colors_list.size()}" + trim_note)
 
     def populate_colors(self):
         self.colors_list.delete(0, END)
-        if self.quant_image is None:
+        if self.color_index is None:
             return
-        w, h = self.quant_image.size
-        seen = {}
-        data = self.quant_image.load()
-        for y in range(h):
-            for x in range(w):
-                if self.draw_mask is not None and not self.draw_mask[y][x]:
-                    continue
-                r, g, b = data[x, y]
-                hx = rgb_to_hex((r, g, b))
-                if hx not in seen:
-                    seen[hx] = 0
-                seen[hx] += 1
-        items = sorted(seen.items(), key=lambda kv: kv[1], reverse=True)
+        items = self.color_index.histogram
         for hx, cnt in items:
             self.colors_list.insert(END, f"{hx}  ({cnt})")
         if items:
             self.colors_list.selection_set(0)
 
     def get_pixels(self):
-        if self.quant_image is None:
-            return []
-        w, h = self.quant_image.size
-        pixels = []
-        data = self.quant_image.load()
-        for y in range(h):
-            for x in range(w):
-                if self.draw_mask is not None and not self.draw_mask[y][x]:
-                    continue
-                r, g, b = data[x, y]
-                pixels.append(Pixel(x=x, y=y, hex_color=rgb_to_hex((r, g, b))))
-        return pixels
+        if self.color_index is None:
+            return PixelSet(get_palette())
+        return self.color_index.pixels
 
     def group_pixels_by_color(self):
-        groups = defaultdict(list)
-        for p in self.get_pixels():
-            groups[p.hex_color].append(p)
-        return groups
+        if self.color_index is None:
+            return {}
+        return self.color_index.groups
 
     # ---------- Calibration ----------
     def set_tl(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None:
             messagebox.showerror("Ошибка", "pyautogui не установлен")
             return
@@ -701,6 +452,7 @@ class WplaceDrawerApp:
         self.update_calib_label()
 
     def set_tr(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None:
             messagebox.showerror("Ошибка", "pyautogui не установлен")
             return
@@ -709,6 +461,7 @@ class WplaceDrawerApp:
         self.update_calib_label()
 
     def set_bl(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None:
             messagebox.showerror("Ошибка", "pyautogui не установлен")
             return
@@ -717,6 +470,7 @@ class WplaceDrawerApp:
         self.update_calib_label()
 
     def set_br(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None:
             messagebox.showerror("Ошибка", "pyautogui не установлен")
             return
@@ -729,32 +483,31 @@ class WplaceDrawerApp:
         tr = f"TR: {self.tr}" if self.tr else "TR: -"
         bl = f"BL: {self.bl}" if self.bl else "BL: -"
         br = f"BR: {self.br}" if self.br else "BR: -"
-        self.calib_lbl.config(text=f"{tl}, {tr}, {bl}, {br}")
-
-    def compute_cell_coords(self, x, y):
+        grid = self.cell_grid()
+        mode = f" [{grid.mode}]" if grid is not None else ""
+        if grid is not None and grid.note:
+            mode += f" — {grid.note}"
+        self.calib_lbl.config(text=f"{tl}, {tr}, {bl}, {br}{mode}")
+
+    def cell_grid(self):
+        """CellGrid for the current calibration and grid size (None if incomplete)"""
         if not self.tl or self.scaled_image is None:
             return None
         w, h = self.scaled_image.size
-        # Prefer 3-point affine grid (TL, TR, BL). Fallback to TL/BR.
-        if self.tr and self.bl:
-            x0, y0 = self.tl
-            tx, ty = self.tr
-            bx, by = self.bl
-            ux_x = 0 if w == 1 else (tx - x0) / (w - 1)
-            ux_y = 0 if w == 1 else (ty - y0) / (w - 1)
-            uy_x = 0 if h == 1 else (bx - x0) / (h - 1)
-            uy_y = 0 if h == 1 else (by - y0) / (h - 1)
-            sx = x0 + ux_x * x + uy_x * y
-            sy = y0 + ux_y * x + uy_y * y
-            return int(round(sx)), int(round(sy))
-        if not self.br:
+        key = (w, h, self.tl, self.tr, self.bl, self.br)
+        grid = self._cell_grid
+        if grid is None or grid.key != key:
+            try:
+                grid = self._cell_grid = CellGrid(w, h, self.tl, self.tr, self.bl, self.br)
+            except ValueError:
+                return None
+        return grid
+
+    def compute_cell_coords(self, x, y):
+        grid = self.cell_grid()
+        if grid is None:
             return None
-        (x0, y0), (x1, y1) = self.tl, self.br
-        step_x = 0 if w == 1 else (x1 - x0) / (w - 1)
-        step_y = 0 if h == 1 else (y1 - y0) / (h - 1)
-        sx = x0 + step_x * x
-        sy = y0 + step_y * y
-        return int(round(sx)), int(round(sy))
+        return grid(x, y)
 
     # ---------- Export ----------
     def export_csv(self):
@@ -770,11 +523,7 @@ class WplaceDrawerApp:
         if not path:
             return
         try:
-            with open(path, "w", newline="", encoding="utf-8") as f:
-                wcsv = csv.writer(f)
-                wcsv.writerow(["x", "y", "hex_color"])  # header
-                for p in pixels:
-                    wcsv.writerow([p.x, p.y, p.hex_color])
+            write_pixels_csv(path, pixels)
             messagebox.showinfo("Готово", f"Сохранено: {os.path.basename(path)}")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить CSV: {e}")
@@ -792,14 +541,8 @@ class WplaceDrawerApp:
         if not path:
             return
         try:
-            w, h = (self.quant_image.size if self.quant_image else (self.scaled_image.size if self.scaled_image else (0,0)))
-            payload = {
-                "width": w,
-                "height": h,
-                "pixels": [p.__dict__ for p in pixels],
-            }
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=2)
+            size = (self.quant_image.size if self.quant_image else (self.scaled_image.size if self.scaled_image else (0,0)))
+            write_pixels_json(path, pixels, size)
             messagebox.showinfo("Готово", f"Сохранено: {os.path.basename(path)}")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить JSON: {e}")
@@ -813,44 +556,111 @@ class WplaceDrawerApp:
             return default
 
     def _draw_pixels(self, pixels):
-        if pyautogui is None:
-            messagebox.showerror("Ошибка", "pyautogui не установлен")
+        started = self._begin_worker()
+        if started is None:
             return
+        driver, sleep_between = started
+        self._click_cells(driver, pixels, sleep_between)
+
+    def _input_driver(self):
+        return INPUT_DRIVERS.get(self.input_driver_var.get(), PyAutoGuiDriver)()
+
+    def _begin_worker(self):
+        """Common start of a draw worker: (driver, pause between clicks) after the start delay.
+
+        None when the input backend is missing or Stop came during the delay.
+        """
+        driver = self._input_driver()
+        if not driver.available():
+            self.root.after(0, messagebox.showerror, "Ошибка", "pyautogui не установлен")
+            return None
         delay = self.parse_float(self.delay_var, 2.0)
         sleep_between = self.parse_float(self.click_sleep_var, 0.05)
         for _ in range(int(delay * 10)):
             if self._stop_flag.is_set():
-                return
+                return None
             time.sleep(0.1)
-        for p in pixels:
+        return driver, sleep_between
+
+    def _calibrated_grid(self):
+        """cell_grid(), warning the user when the calibration is incomplete"""
+        grid = self.cell_grid()
+        if grid is None:
+            messagebox.showwarning("Нет калибровки", "Укажите центры ячеек TL и BR (или TL, TR, BL) перед рисованием")
+        return grid
+
+    def _click_cells(self, driver, pixels, sleep_between):
+        """Click every cell in order; False once stopped or input failed"""
+        grid = self.cell_grid()
+        if grid is None:
+            return False
+        screen_x, screen_y, w = grid.xs, grid.ys, grid.width
+        journal = self._journal
+        budget = self._budget
+        for x, y in zip(pixels.xs, pixels.ys):
             if self._stop_flag.is_set():
-                return
-            tgt = self.compute_cell_coords(p.x, p.y)
-            if tgt is None:
-                return
+                return False
+            # paint in bursts: idle (interruptibly) until a charge regenerates
+            if budget is not None and not budget.acquire(self._charge_wait):
+                return False
+            i = y * w + x
             try:
-                pyautogui.moveTo(tgt[0], tgt[1])
-                pyautogui.click()
-                time.sleep(sleep_between)
-            except Exception:
-                return
+                driver.click_at(screen_x[i], screen_y[i])
+                if journal is not None:
+                    journal.record(i)
+                self._cells_left -= 1
+                driver.wait(sleep_between)
+            except Exception as e:
+                # includes pyautogui.FailSafeException (cursor in the corner)
+                self.root.after(0, self.info_var.set, f"Остановлено ({type(e).__name__}), прогресс сохранён")
+                return False
+        return True
+
+    def _prepare_run(self, cells, fresh_journal=False):
+        """Per-run state for the draw thread: journal and charge budget"""
+        self._open_journal(fresh_journal)
+        self._budget = self._make_budget()
+        self._cells_left = cells
+        self._click_time = self._cost_model().click_cost()
+
+    def _open_journal(self, fresh=False):
+        """Journal for the current plan and calibration (None if it can't be written)"""
+        try:
+            key = plan_key(self.quant_image, self.draw_mask, self.cell_grid())
+            self._journal = DrawJournal(key).open(fresh)
+        except OSError:
+            self._journal = None
+
+    def _run_journaled(self, worker, *args):
+        try:
+            worker(*args)
+        finally:
+            journal, self._journal = self._journal, None
+            if journal is not None:
+                journal.close()
+            budget, self._budget = self._budget, None
+            if budget is not None:
+                # carry the unspent charges over to the next run
+                self.root.after(0, self.budget_tokens_var.set, str(budget.available()))
 
     def start_draw_thread(self, pixels):
         if not pixels:
             messagebox.showinfo("Нет пикселей", "Нечего рисовать")
             return
-        if not self.tl or not self.br:
-            messagebox.showwarning("Нет калибровки", "Укажите TL и BR центры ячеек перед рисованием")
+        if self._calibrated_grid() is None:
             return
         if self._draw_thread and self._draw_thread.is_alive():
             messagebox.showinfo("Уже идёт", "Дождитесь завершения или нажмите Стоп")
             return
         self._stop_flag.clear()
-        self._draw_thread = threading.Thread(target=self._draw_pixels, args=(pixels,), daemon=True)
+        self._prepare_run(len(pixels))
+        self._draw_thread = threading.Thread(target=self._run_journaled, args=(self._draw_pixels, pixels),
+                                             daemon=True)
         self._draw_thread.start()
 
-    def select_palette_color(self, hx: str):
-        if pyautogui is None:
+    def select_palette_color(self, hx: str, driver=None):
+        driver = driver or self._input_driver()
+        if not driver.available():
             return
         # If explicit binding exists — use it
         pos = self.palette_coords.get(hx)
@@ -860,9 +670,8 @@ class WplaceDrawerApp:
         if not pos:
             return
         try:
-            pyautogui.moveTo(pos[0], pos[1])
-            pyautogui.click()
-            time.sleep(0.2)
+            driver.click_at(pos[0], pos[1])
+            driver.wait(0.2)
         except Exception:
             pass
 
@@ -877,67 +686,245 @@ class WplaceDrawerApp:
             return
         item = self.colors_list.get(sel[0])
         hx = item.split()[0]
-        pixels = groups.get(hx, [])
-        self.select_palette_color(hx)
-        self.start_draw_thread(pixels)
 
-    def start_draw_thread_with_color_switch(self, sequence):
+        def start(plan):
+            pixels, before, after, predicted = plan
+            self._report_travel(before, after, self._forecast(predicted, len(pixels)))
+            self._swatch_index = None
+            self.select_palette_color(hx)
+            self.start_draw_thread(pixels)
+
+        self._plan_in_background(self.color_index.cells(hx), start, self._stroke_planner(hx))
+
+    def start_draw_thread_with_color_switch(self, sequence, fresh_journal=False):
         if not sequence:
             return
-        if not self.tl or not self.br:
-            messagebox.showwarning("Нет калибровки", "Укажите TL и BR центры ячеек перед рисованием")
+        if self._calibrated_grid() is None:
             return
         if self._draw_thread and self._draw_thread.is_alive():
             messagebox.showinfo("Уже идёт", "Дождитесь завершения или нажмите Стоп")
             return
         self._stop_flag.clear()
-        self._draw_thread = threading.Thread(target=self._draw_with_switch_worker, args=(sequence,), daemon=True)
+        self._swatch_index = None
+        self._prepare_run(sum(len(item) for item in sequence if not isinstance(item, tuple)), fresh_journal)
+        self._draw_thread = threading.Thread(target=self._run_journaled,
+                                             args=(self._draw_with_switch_worker, sequence), daemon=True)
         self._draw_thread.start()
 
     def _draw_with_switch_worker(self, sequence):
-        if pyautogui is None:
-            messagebox.showerror("Ошибка", "pyautogui не установлен")
+        started = self._begin_worker()
+        if started is None:
             return
-        delay = self.parse_float(self.delay_var, 2.0)
-        sleep_between = self.parse_float(self.click_sleep_var, 0.05)
-        for _ in range(int(delay * 10)):
-            if self._stop_flag.is_set():
-                return
-            time.sleep(0.1)
+        driver, sleep_between = started
+        self._run_sequence(driver, sequence, sleep_between)
+
+    def _run_sequence(self, driver, sequence, sleep_between):
+        """Play ("COLOR", hx) / PixelSet steps; False once stopped or input failed"""
         for item in sequence:
             if self._stop_flag.is_set():
-                return
+                return False
             if isinstance(item, tuple) and item[0] == "COLOR":
                 hx = item[1]
-                self.select_palette_color(hx)
+                self.select_palette_color(hx, driver)
                 continue
-            tgt = self.compute_cell_coords(item.x, item.y)
-            if tgt is None:
-                return
-            try:
-                pyautogui.moveTo(tgt[0], tgt[1])
-                pyautogui.click()
-                time.sleep(sleep_between)
-            except Exception:
-                return
+            # PixelSet step: every cell of it in order
+            if not self._click_cells(driver, item, sleep_between):
+                return False
+        return True
 
     def draw_all_colors(self):
         groups = self.group_pixels_by_color()
         if not groups:
             messagebox.showinfo("Нет данных", "Нет пикселей для рисования")
             return
-        order = sorted(groups.items(), key=lambda kv: len(kv[1]), reverse=True)
-        seq = []
-        for hx, arr in order:
-            seq.append(("COLOR", hx))
-            seq.extend(arr)
-        self.start_draw_thread_with_color_switch(seq)
+        if self._calibrated_grid() is None:
+            return
+        self._plan_in_background(groups, self._start_full_run)
+
+    def _start_full_run(self, plan):
+        seq, predicted, travel, switches, before = plan
+        self._report_travel(before, travel, self._forecast(predicted, len(self.color_index.pixels)), switches)
+        # a full run starts a new journal; resume_drawing continues it
+        self.start_draw_thread_with_color_switch(seq, fresh_journal=True)
+
+    def resume_drawing(self):
+        """Continue a stopped run: only cells not in the journal, only their colors"""
+        if self.color_index is None:
+            messagebox.showinfo("Нет данных", "Нет пикселей для рисования")
+            return
+        grid = self._calibrated_grid()
+        if grid is None:
+            return
+        done = DrawJournal(plan_key(self.quant_image, self.draw_mask, grid)).load()
+        pixels = self.color_index.pixels
+        w = grid.width
+        left = pixels.take([i for i, (x, y) in enumerate(zip(pixels.xs, pixels.ys)) if y * w + x not in done])
+        if not len(left):
+            messagebox.showinfo("Готово", "Все ячейки этого плана уже нарисованы")
+            return
+
+        def start(plan):
+            seq, predicted, _, switches, _ = plan
+            self.info_var.set(f"Продолжение: осталось {len(left)} из {len(pixels)} ячеек, "
+                              f"смен цвета: {switches}, прогноз: {self._forecast(predicted, len(left))}")
+            self.start_draw_thread_with_color_switch(seq)
+
+        self._plan_in_background(left.group_by_color(), start)
+
+    def _sequence_planner(self):
+        """plan(groups) with the settings read now; safe to call off the Tk thread"""
+        regions = self.regions_var.get()
+        regions = None if regions == "авто" else int(regions.split("x")[0])
+        args = (self.scaled_image.size, self.stroke_order_var.get(), self.cell_grid(),
+                self._swatch_position, self._cost_model(), regions)
+        return lambda groups: plan_color_sequence(groups, *args)
+
+    def _plan_in_background(self, groups, on_planned, plan=None):
+        """Run plan(groups) on a worker thread, then on_planned(result) on Tk.
+
+        Stroke and sequence planning can take seconds on big colors. `plan`
+        defaults to the color sequence planner.
+        """
+        if self._plan_thread is not None and self._plan_thread.is_alive():
+            messagebox.showinfo("Уже идёт", "Дождитесь окончания планирования")
+            return
+        plan = plan or self._sequence_planner()
+        source = self.quant_image
+        self.info_var.set("Планирование порядка рисования…")
+
+        def deliver(result):
+            if self.quant_image is not source:
+                self.info_var.set("План отброшен: изображение изменилось")
+                return
+            on_planned(result)
+
+        def work():
+            try:
+                result = plan(groups)
+            except Exception as e:
+                self.root.after(0, messagebox.showerror, "Ошибка", f"Не удалось спланировать рисование: {e}")
+                return
+            self.root.after(0, deliver, result)
+
+        self._plan_thread = threading.Thread(target=work, daemon=True)
+        self._plan_thread.start()
+
+    # ---------- Verify / repair ----------
+    def find_mismatched_cells(self):
+        """Cells the canvas on screen does not show in the right color yet"""
+        tol = self.get_int(self.verify_tol_var, 24)
+        return diff_cells(self.quant_image, self.draw_mask, self.cell_grid(), self.screen_capture, tol)
+
+    def verify_and_repair(self):
+        if self.quant_image is None:
+            messagebox.showinfo("Нет данных", "Нет пикселей для рисования")
+            return
+        if self._calibrated_grid() is None:
+            return
+        if self._draw_thread and self._draw_thread.is_alive():
+            messagebox.showinfo("Уже идёт", "Дождитесь завершения или нажмите Стоп")
+            return
+        passes = self.get_int(self.repair_passes_var, 2)
+        self._stop_flag.clear()
+        self._swatch_index = None
+        self._prepare_run(0)
+        self._draw_thread = threading.Thread(target=self._run_journaled,
+                                             args=(self._repair_worker, passes, self._sequence_planner()),
+                                             daemon=True)
+        self._draw_thread.start()
+
+    def _repair_worker(self, passes, plan):
+        started = self._begin_worker()
+        if started is None:
+            return
+        driver, sleep_between = started
+        # each pass: one capture, then draw only what differs; final capture just reports
+        for n in range(passes + 1):
+            try:
+                bad = self.find_mismatched_cells()
+            except Exception as e:
+                self.root.after(0, self.info_var.set, f"Проверка не удалась: {e}")
+                return
+            if not len(bad):
+                self.root.after(0, self.info_var.set, "Проверка: всё совпадает")
+                return
+            if n == passes:
+                self.root.after(0, self.info_var.set, f"После {passes} проходов неверных ячеек: {len(bad)}")
+                return
+            seq, predicted, _, _, _ = plan(bad.group_by_color())
+            self.root.after(0, self.info_var.set,
+                            f"Проход {n + 1}: неверных ячеек {len(bad)}, прогноз {self._forecast(predicted, len(bad))}")
+            self._cells_left = len(bad)
+            if not self._run_sequence(driver, seq, sleep_between):
+                return
+            time.sleep(0.5)  # let the canvas catch up before capturing again
+
+    def _cost_model(self):
+        driver = self._input_driver()
+        return DrawCostModel(
+            click_sleep=self.parse_float(self.click_sleep_var, 0.05),
+            input_pause=driver.implicit_pause() if driver.available() else 0.0,
+            start_delay=self.parse_float(self.delay_var, 2.0),
+        )
+
+    def _swatch_position(self, hx):
+        # bound swatch, else the middle of the palette area as an estimate
+        pos = self.palette_coords.get(hx)
+        if pos:
+            return pos
+        if self.pal_tl and self.pal_br:
+            return ((self.pal_tl[0] + self.pal_br[0]) / 2, (self.pal_tl[1] + self.pal_br[1]) / 2)
+        return None
+
+    def _stroke_planner(self, hx):
+        """plan(pixels) -> (ordered, travel before, after, predicted s) for one color; safe off the Tk thread"""
+        strategy, grid, model = self.stroke_order_var.get(), self.cell_grid(), self._cost_model()
+
+        def plan(pixels):
+            ordered, before, after = plan_strokes(pixels, strategy, grid)
+            predicted = predict_sequence_duration([("COLOR", hx), ordered], grid, self._swatch_position, model)
+            return ordered, before, after, predicted
+        return plan
+
+    def _report_travel(self, before, after, predicted, switches=None):
+        saved = 100.0 * (1 - after / before) if before > 0 else 0.0
+        note = f", смен цвета: {switches}" if switches is not None else ""
+        self.info_var.set(f"Путь курсора: {before:.0f} → {after:.0f} px (−{saved:.0f}%), "
+                          f"прогноз: {predicted}" + note)
+
+    def _make_budget(self):
+        if self.budget_enabled_var.get() != "1":
+            return None
+        capacity = self.get_int(self.budget_capacity_var, 30)
+        try:
+            tokens = int(self.budget_tokens_var.get())  # 0 is valid here, unlike get_int
+        except ValueError:
+            tokens = capacity
+        return ChargeBudget(capacity, self.parse_float(self.budget_regen_var, 30.0), tokens,
+                            sleep=self._stop_flag.wait)
+
+    def _forecast(self, predicted, cells):
+        """Planned duration, stretched by the charge budget, and the wall-clock finish"""
+        budget = self._make_budget()
+        if budget is not None and cells:
+            model = self._cost_model()
+            click_time = (predicted - model.start_delay) / cells
+            predicted = max(predicted, model.start_delay + budget.time_to_paint(cells, click_time))
+        finish = time.strftime("%H:%M", time.localtime(time.time() + predicted))
+        return f"{format_duration(predicted)} (≈ {finish})"
+
+    def _charge_wait(self, delay):
+        remaining = self._budget.time_to_paint(self._cells_left, self._click_time)
+        finish = time.strftime("%H:%M:%S", time.localtime(time.time() + remaining))
+        self.root.after(0, self.info_var.set, f"Ожидание заряда: {delay:.0f} с, осталось ячеек: "
+                                              f"{self._cells_left}, завершение ≈ {finish}")
 
     def request_stop(self):
         self._stop_flag.set()
 
     # ---------- Palette binding save/load ----------
     def bind_palette_for_selected(self):
+        pyautogui = get_pyautogui()
         sel = self.colors_list.curselection()
         if not sel:
             messagebox.showinfo("Не выбран цвет", "Выберите цвет справа")
@@ -975,50 +962,147 @@ class WplaceDrawerApp:
             messagebox.showerror("Ошибка", f"Не удалось загрузить: {e}")
 
     # ---------- Preview ----------
+    def schedule_preview(self, event=None):
+        """Debounced refresh_preview: a burst of <Configure> events redraws once"""
+        if self._preview_after is not None:
+            self.root.after_cancel(self._preview_after)
+        self._preview_after = self.root.after(80, self.refresh_preview)
+
+    def _tile_cells(self, zoom):
+        """Cells per tile side at `zoom`; a tile is about PREVIEW_TILE_PX wide on screen"""
+        if zoom >= 1:
+            return max(1, self.PREVIEW_TILE_PX // int(zoom))
+        return self.PREVIEW_TILE_PX * int(round(1 / zoom))
+
+    def _tile_photo(self, zoom, tx, ty):
+        """PhotoImage of tile (tx, ty) at `zoom`, cached per (zoom, tile, highlight)"""
+        key = (zoom, tx, ty, self.highlight_color)
+        photo = self._tile_cache.pop(key, None)
+        if photo is None:
+            from PIL import ImageTk
+            tc = self._tile_cells(zoom)
+            w, h = self.quant_image.size
+            box = (tx * tc, ty * tc, min(w, (tx + 1) * tc), min(h, (ty + 1) * tc))
+            img = render_preview_region(self.quant_image, self.draw_mask, box, zoom, self.highlight_color,
+                                        self.transparent_bg)
+            photo = ImageTk.PhotoImage(img)
+            while len(self._tile_cache) >= self.PREVIEW_TILE_CACHE:
+                self._tile_cache.pop(next(iter(self._tile_cache)))
+        self._tile_cache[key] = photo  # re-insert: most recently used last
+        return photo
+
+    def _fit_view(self, cw, ch):
+        """Largest whole px-per-cell scale showing the whole image (a level below 1), centered"""
+        w, h = self.quant_image.size
+        pad = 10
+        fit = min(max(1, cw - pad * 2) / w, max(1, ch - pad * 2) / h)
+        if fit >= 1:
+            zoom = int(fit)
+        else:
+            zoom = ZOOM_LEVELS[0]
+            for level in ZOOM_LEVELS:
+                if level <= fit:
+                    zoom = level
+        self._view_zoom = zoom
+        self._view_x = w / 2 - cw / (2 * zoom)
+        self._view_y = h / 2 - ch / (2 * zoom)
+
     def refresh_preview(self, event=None):
-        self.canvas.delete("all")
+        """Draw only the tiles intersecting the canvas at the current zoom and pan"""
+        self._preview_after = None
         if self.quant_image is None:
+            self.canvas.delete("all")
+            self._tile_items.clear()
+            self._zoom_label = None
             return
+        if self._preview_source is not self.quant_image:
+            self._tile_cache.clear()
+            self._preview_source = self.quant_image
+            self._view_fit = True
         cw = self.canvas.winfo_width() or 800
         ch = self.canvas.winfo_height() or 600
+        if self._view_fit:
+            self._fit_view(cw, ch)
+        zoom = self._view_zoom
         w, h = self.quant_image.size
-        pad = 10
-        max_w = max(1, cw - pad * 2)
-        max_h = max(1, ch - pad * 2)
-        scale = min(max_w / w, max_h / h)
-        scale = max(1, int(scale))
-        big = self.quant_image.resize((w * scale, h * scale), Image.NEAREST)
-        self.preview_image = ImageTk.PhotoImage(big)
-        x0 = (cw - big.width) // 2
-        y0 = (ch - big.height) // 2
-        self.canvas.create_image(x0, y0, image=self.preview_image, anchor="nw")
-        grid_color = "#444444"
-        for ix in range(w + 1):
-            x = x0 + ix * scale
-            self.canvas.create_line(x, y0, x, y0 + h * scale, fill=grid_color)
-        for iy in range(h + 1):
-            y = y0 + iy * scale
-            self.canvas.create_line(x0, y, x0 + w * scale, y, fill=grid_color)
-
-        # highlight selected color cells
-        if self.highlight_color:
-            data = self.quant_image.load()
-            outline = "#FFEE00"
-            for yy in range(h):
-                for xx in range(w):
-                    if self.draw_mask is not None and not self.draw_mask[yy][xx]:
-                        continue
-                    r, g, b = data[xx, yy]
-                    if rgb_to_hex((r, g, b)).upper() == self.highlight_color.upper():
-                        rx0 = x0 + xx * scale
-                        ry0 = y0 + yy * scale
-                        rx1 = rx0 + scale
-                        ry1 = ry0 + scale
-                        self.canvas.create_rectangle(rx0, ry0, rx1, ry1, outline=outline, width=max(1, scale//6))
+        tc = self._tile_cells(zoom)
+        span = int(round(tc * zoom))  # tile side in screen px
+        ox = int(round(-self._view_x * zoom))
+        oy = int(round(-self._view_y * zoom))
+        tx0 = max(0, int(self._view_x // tc))
+        ty0 = max(0, int(self._view_y // tc))
+        tx1 = min((w - 1) // tc, int((self._view_x + cw / zoom) // tc))
+        ty1 = min((h - 1) // tc, int((self._view_y + ch / zoom) // tc))
+        visible = {}
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                photo = self._tile_photo(zoom, tx, ty)
+                x, y = ox + tx * span, oy + ty * span
+                item = self._tile_items.pop((tx, ty), (None, None))[0]
+                if item is None:
+                    item = self.canvas.create_image(x, y, image=photo, anchor="nw")
+                else:
+                    self.canvas.itemconfig(item, image=photo)
+                    self.canvas.coords(item, x, y)
+                visible[(tx, ty)] = (item, photo)  # the item needs its photo alive
+        for item, _photo in self._tile_items.values():
+            self.canvas.delete(item)
+        self._tile_items = visible
+        label = f"×{zoom:g}" if zoom >= 1 else f"1/{int(round(1 / zoom))}"
+        if self._zoom_label is None:
+            self._zoom_label = self.canvas.create_text(6, 6, text=label, anchor="nw", fill="#dddddd")
+        else:
+            self.canvas.itemconfig(self._zoom_label, text=label)
+            self.canvas.tag_raise(self._zoom_label)
+
+    def zoom_preview(self, steps, x, y):
+        """Move `steps` zoom levels, keeping the cell under canvas point (x, y) in place"""
+        if self.quant_image is None or self._view_zoom is None:
+            return
+        # the fitted zoom may lie between levels (or above the last one)
+        z0 = self._view_zoom
+        if steps > 0:
+            levels = [z for z in ZOOM_LEVELS if z > z0]
+            z1 = levels[min(steps, len(levels)) - 1] if levels else z0
+        else:
+            levels = [z for z in ZOOM_LEVELS if z < z0]
+            z1 = levels[-min(-steps, len(levels))] if levels else z0
+        if z1 == z0:
+            return
+        self._view_x += x / z0 - x / z1
+        self._view_y += y / z0 - y / z1
+        self._view_zoom = z1
+        self._view_fit = False
+        self.refresh_preview()
+
+    def _on_preview_wheel(self, event):
+        up = event.num == 4 or event.delta > 0
+        self.zoom_preview(1 if up else -1, event.x, event.y)
+        return "break"  # keep the right panel's bind_all scroll out of it
 
+    def _on_pan_start(self, event):
+        self._pan_anchor = (event.x, event.y, self._view_x, self._view_y)
+
+    def _on_pan_drag(self, event):
+        if self._pan_anchor is None or self.quant_image is None or self._view_zoom is None:
+            return
+        x, y, vx, vy = self._pan_anchor
+        w, h = self.quant_image.size
+        cw = self.canvas.winfo_width() or 800
+        ch = self.canvas.winfo_height() or 600
+        # keep at least one cell on screen
+        self._view_x = min(w - 1, max(1 - cw / self._view_zoom, vx - (event.x - x) / self._view_zoom))
+        self._view_y = min(h - 1, max(1 - ch / self._view_zoom, vy - (event.y - y) / self._view_zoom))
+        self._view_fit = False
+        self.refresh_preview()
+
+    def fit_preview(self, event=None):
+        self._view_fit = True
+        self.refresh_preview()
 
     # ---------- Palette area calibration ----------
     def set_palette_tl(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None:
             messagebox.showerror("Ошибка", "pyautogui не установлен")
             return
@@ -1026,88 +1110,49 @@ class WplaceDrawerApp:
         messagebox.showinfo("OK", f"Palette TL: {self.pal_tl}")
 
     def set_palette_br(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None:
             messagebox.showerror("Ошибка", "pyautogui не установлен")
             return
         self.pal_br = pyautogui.position()
         messagebox.showinfo("OK", f"Palette BR: {self.pal_br}")
 
+    def _capture_swatch_index(self, known=None):
+        pyautogui = get_pyautogui()
+        x0, y0 = self.pal_tl
+        x1, y1 = self.pal_br
+        if x1 <= x0 or y1 <= y0:
+            return None
+        shot = pyautogui.screenshot(region=(x0, y0, x1 - x0, y1 - y0))
+        return SwatchIndex(shot, (x0, y0), known)
+
     def auto_find_palette_color(self, hx: str):
         # requires palette TL/BR
+        pyautogui = get_pyautogui()
         if pyautogui is None or not self.pal_tl or not self.pal_br:
             return None
         try:
-            x0, y0 = self.pal_tl
-            x1, y1 = self.pal_br
-            if x1 <= x0 or y1 <= y0:
-                return None
-            shot = pyautogui.screenshot(region=(x0, y0, x1 - x0, y1 - y0))
-            target = hex_to_rgb(hx)
-            w, h = shot.size
-            best = None
-            best_d = 1e18
-            step = max(1, min(w, h) // 60)  # coarse scan
-            pix = shot.load()
-            for yy in range(0, h, step):
-                for xx in range(0, w, step):
-                    r, g, b = pix[xx, yy][:3]
-                    d = (r - target[0])**2 + (g - target[1])**2 + (b - target[2])**2
-                    if d < best_d:
-                        best_d = d
-                        best = (x0 + xx, y0 + yy)
-            return best
+            # one capture per drawing session; recaptured only when nothing in it
+            # matches the color, and then every earlier answer is carried over
+            index = self._swatch_index
+            fresh = index is None
+            if fresh:
+                index = self._swatch_index = self._capture_swatch_index()
+                if index is None:
+                    return None
+            pos = index.lookup(hx) or index.search(hx, SWATCH_MATCH_TOL)
+            if pos is None and not fresh:
+                recaptured = self._capture_swatch_index(index.positions)
+                if recaptured is not None:
+                    index = self._swatch_index = recaptured
+                    pos = index.lookup(hx)
+            # best effort: the closest pixel, remembered so the color never recaptures again
+            return pos or index.search(hx)
         except Exception:
             return None
 
-    def _downsample_image(self, img, max_side=240):
-        w, h = img.size
-        scale = min(1.0, max_side / max(w, h))
-        if scale < 1.0:
-            img = img.resize((int(w*scale), int(h*scale)), Image.BILINEAR)
-        return img
-
-    def _kmeans_colors(self, pixels, k, iters=8):
-        # pixels: list of (r,g,b)
-        if not pixels:
-            return []
-        k = max(1, min(k, len(pixels)))
-        centers = random.sample(pixels, k)
-        for _ in range(iters):
-            buckets = [[] for _ in range(k)]
-            for r,g,b in pixels:
-                bi = 0
-                bd = 1e18
-                for i,(cr,cg,cb) in enumerate(centers):
-                    d = (r-cr)*(r-cr) + (g-cg)*(g-cg) + (b-cb)*(b-cb)
-                    if d < bd:
-                        bd = d
-                        bi = i
-                buckets[bi].append((r,g,b))
-            new_centers = []
-            for bucket in buckets:
-                if bucket:
-                    sr = sum(p[0] for p in bucket)
-                    sg = sum(p[1] for p in bucket)
-                    sb = sum(p[2] for p in bucket)
-                    n = len(bucket)
-                    new_centers.append((sr//n, sg//n, sb//n))
-            if len(new_centers) < k:
-                # refill missing with random
-                while len(new_centers) < k:
-                    new_centers.append(random.choice(pixels))
-            if new_centers == centers:
-                break
-            centers = new_centers
-        # unique centers
-        seen = set()
-        uniq = []
-        for c in centers:
-            if c not in seen:
-                seen.add(c)
-                uniq.append(c)
-        return uniq
-
     def build_palette_from_screen(self):
+        pyautogui = get_pyautogui()
         if pyautogui is None or not self.pal_tl or not self.pal_br:
             messagebox.showwarning("Нет области", "Укажите TL и BR области палитры")
             return
@@ -1122,22 +1167,22 @@ class WplaceDrawerApp:
                 messagebox.showerror("Ошибка", "Неверная область палитры")
                 return
             shot = pyautogui.screenshot(region=(x0, y0, x1 - x0, y1 - y0))
-            shot = self._downsample_image(shot.convert('RGB'))
-            w, h = shot.size
-            pix = shot.load()
-            pts = []
-            step = max(1, min(w, h)//80)
-            for yy in range(0, h, step):
-                for xx in range(0, w, step):
-                    r,g,b = pix[xx, yy]
-                    pts.append((r,g,b))
-            centers = self._kmeans_colors(pts, k)
-            hexes = [rgb_to_hex(c) for c in centers]
+            swatches = detect_swatches(shot)
+            if swatches:
+                # exact swatch colors, and their centers become the bindings
+                hexes = [rgb_to_hex(sw.rgb) for sw in swatches]
+                for hx, sw in zip(hexes, swatches):
+                    self.palette_coords[hx] = (x0 + sw.center[0], y0 + sw.center[1])
+                note = f"Найдено образцов: {len(swatches)}, координаты привязаны"
+            else:
+                # no clear tiles: fall back to clustering the capture
+                hexes = [rgb_to_hex(c) for c in kmeans_palette(shot, k)]
+                note = "Образцы не найдены, палитра подобрана k-means"
             set_palette(hexes)
             # re-quantize using new palette
             if self.scaled_image is not None:
                 self.apply_resize()
-            messagebox.showinfo("Палитра обновлена", f"Цветов: {len(get_palette())}")
+            messagebox.showinfo("Палитра обновлена", f"Цветов: {len(get_palette())}. {note}")
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось собрать палитру: {e}")
 
@@ -1146,13 +1191,7 @@ class WplaceDrawerApp:
         if not path:
             return
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            if isinstance(data, dict) and 'palette' in data:
-                hexes = data['palette']
-            else:
-                hexes = data
-            set_palette(hexes)
+            set_palette(read_palette_json(path))
             if self.scaled_image is not None:
                 self.apply_resize()
             messagebox.showinfo("Готово", f"Загружено {len(get_palette())} цветов")
@@ -1192,24 +1231,11 @@ class WplaceDrawerApp:
             k = 24
         
         try:
-            # Downsample for faster processing
-            img = self._downsample_image(self.scaled_image.convert('RGB'))
-            w, h = img.size
-            pix = img.load()
-            
-            # Sample pixels from the image
-            pixels = []
-            for y in range(h):
-                for x in range(w):
-                    r, g, b = pix[x, y]
-                    pixels.append((r, g, b))
-            
-            if not pixels:
+            # Use k-means clustering to find dominant colors
+            centers = kmeans_palette(self.scaled_image, k)
+            if not centers:
                 messagebox.showwarning("Предупреждение", "Нет пикселей для анализа")
                 return
-            
-            # Use k-means clustering to find dominant colors
-            centers = self._kmeans_colors(pixels, k)
             hexes = [rgb_to_hex(c) for c in centers]
             
             # Update palette
@@ -1246,8 +1272,35 @@ class WplaceDrawerApp:
         self.refresh_preview()
 
 
-if __name__ == "__main__":
+def _report_startup(root, target):
+    """Write startup timings once the window is idle and close it.
+
+    `target` is a file to append to, or "-" for stdout (the windowed
+    PyInstaller build has no console, so build_exe.py passes a file).
+    """
+    now = time.perf_counter()
+    modules = [m for m in ("numpy", "PIL.Image", "pyautogui") if m in sys.modules]
+    line = (f"import {(_T_IMPORTED - _T_START) * 1000:.1f} ms, "
+            f"window ready {(now - _T_START) * 1000:.1f} ms, "
+            f"loaded: {', '.join(modules) or '-'}")
+    if target == "-":
+        print(line)
+    else:
+        with open(target, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    root.destroy()
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
     root = Tk()
     app = WplaceDrawerApp(root)
+    for arg in argv:
+        # --startup-timing[=FILE]: measure import + first idle, then exit
+        if arg == "--startup-timing" or arg.startswith("--startup-timing="):
+            target = arg.partition("=")[2] or "-"
+            root.after_idle(_report_startup, root, target)
     root.mainloop()
 
+
+if __name__ == "__main__":
+    main()